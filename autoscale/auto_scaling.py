@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# Copyright (c) 2013 Eugene Zhuk.
+# Use of this source code is governed by the MIT license that can be found
+# in the LICENSE file.
+
+"""Calls AWS Auto Scaling and CloudWatch APIs.
+
+Connections are kept per thread, so that scripts can make requests from
+a pool of them. Requests are retried with exponential backoff while
+throttled, paginated results are fetched in full, and a token bucket caps
+the rate of changes shared by all threads.
+"""
+
+import boto.ec2.autoscale
+import boto.ec2.cloudwatch
+import boto.exception
+import random
+import threading
+import time
+
+
+class Defaults(object):
+    """Default settings.
+    """
+    RETRIES = 8
+    BACKOFF = 0.5
+
+
+_local = threading.local()
+
+
+def connect():
+    """Returns Auto Scaling and CloudWatch connections that belong to the
+    calling thread, since connections can not be shared between threads.
+    """
+    if not hasattr(_local, 'connections'):
+        _local.connections = (boto.connect_autoscale(),
+            boto.connect_cloudwatch())
+    return _local.connections
+
+
+def call(fn, *args, **kwargs):
+    """Calls an API function, backing off exponentially while requests
+    are throttled.
+    """
+    delay = Defaults.BACKOFF
+    for i in xrange(Defaults.RETRIES):
+        try:
+            return fn(*args, **kwargs)
+        except boto.exception.BotoServerError, err:
+            if 'Throttling' != err.error_code or Defaults.RETRIES - 1 == i:
+                raise
+        time.sleep(random.uniform(0, delay))
+        delay *= 2
+
+
+def get_all(fn, **kwargs):
+    """Returns all results of a paginated API function.
+    """
+    items = list()
+    while True:
+        rs = call(fn, **kwargs)
+        items.extend(rs)
+        if not rs.next_token:
+            return items
+        kwargs['next_token'] = rs.next_token
+
+
+def chunks(items, size):
+    return [items[i:i + size] for i in xrange(0, len(items), size)]
+
+
+class RateLimiter(object):
+    """A thread-safe token bucket that caps the number of requests per
+    second shared by all threads. A rate of zero disables the limit.
+    """
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if 0 >= self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.rate,
+                    self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if 1 <= self.tokens:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
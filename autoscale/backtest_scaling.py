@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# Copyright (c) 2014 Eugene Zhuk.
+# Use of this source code is governed by the MIT license that can be found
+# in the LICENSE file.
+
+"""Backtests CPU threshold scaling policies.
+
+Replays historical CPU utilization (and optionally request rate) exported
+from CloudWatch as CSV against a grid of candidate thresholds, adjustments
+and evaluation periods as configured by configure_auto_scaling.py, and
+reports instance-hours, the share of time instances were overloaded and
+the number of scaling actions for each candidate.
+
+All candidates with the same period are simulated at once with NumPy, so
+that sweeping thousands of combinations over a month of 1-minute data
+takes seconds.
+
+Usage:
+    ./backtest_scaling.py [options] <file.csv>...
+"""
+
+import calendar
+import csv
+import numpy
+import optparse
+import sys
+import time
+
+
+class Error(Exception):
+    pass
+
+
+class Defaults(object):
+    """Default settings.
+    """
+    CPU = 'CPUUtilization'
+    INSTANCES = '2'
+    MIN_INSTANCES = 2
+    MAX_INSTANCES = 4
+    MIN_THRESHOLDS = '20:50:5'
+    MAX_THRESHOLDS = '50:90:5'
+    ADJUSTMENTS = '1,2,3'
+    PERIODS = '60,300,600,900'
+    COOLDOWN = 300
+    LIMIT = 80
+    SORT = 'hours'
+    TOP = 20
+    TIME_FORMATS = ['%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S.%fZ',
+        '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y/%m/%d %H:%M']
+
+
+def _parse_time(value):
+    for f in Defaults.TIME_FORMATS:
+        try:
+            return calendar.timegm(time.strptime(value.strip(), f))
+        except ValueError:
+            pass
+    raise Error('unsupported timestamp \'{0}\''.format(value))
+
+
+def read_series(paths):
+    """Reads CSV files with a timestamp in the first column and a metric in
+    every other column, and returns a dictionary of column names to
+    dictionaries of timestamps to values. Empty cells are skipped.
+    """
+    series = dict()
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                rows = list(csv.reader(f))
+        except IOError, err:
+            raise Error('could not read \'{0}\': {1}'.format(path,
+                err.strerror))
+        if not rows:
+            raise Error('\'{0}\' is empty'.format(path))
+        header = [h.strip() for h in rows[0]]
+        for row in rows[1:]:
+            if not row or not row[0].strip():
+                continue
+            t = _parse_time(row[0])
+            for name, value in zip(header[1:], row[1:]):
+                if value.strip():
+                    try:
+                        series.setdefault(name, dict())[t] = float(value)
+                    except ValueError:
+                        raise Error('invalid value \'{0}\' in \'{1}\''
+                            .format(value, path))
+    return series
+
+
+def _find_column(series, name):
+    """Returns the values of the column whose name starts with the specified
+    name, since exports append the statistic to the metric name.
+    """
+    for k in sorted(series):
+        if k.startswith(name):
+            return series[k]
+    raise Error('could not find column \'{0}\''.format(name))
+
+
+def resample(values, start, end, resolution):
+    """Returns the values at regular intervals between start and end, where
+    gaps are filled with the last known value.
+    """
+    ts = numpy.array(sorted(values), dtype=numpy.int64)
+    vs = numpy.array([values[t] for t in ts], dtype=numpy.float64)
+    grid = numpy.arange(start, end + 1, resolution, dtype=numpy.int64)
+    return vs[numpy.maximum(numpy.searchsorted(ts, grid, 'right') - 1, 0)]
+
+
+def estimate_load(cpu, instances, requests):
+    """Returns the load in percent of a single instance (i.e., 150 is one
+    and a half instances fully utilized). If the request rate is known,
+    the load is derived from it instead, since CPU utilization depends on
+    the number of instances that were running at the time.
+    """
+    load = cpu * instances
+    if requests is not None:
+        valid = 0 < requests
+        if not valid.any():
+            raise Error('request rate is always zero')
+        load = requests * numpy.median(load[valid] / requests[valid])
+    return load
+
+
+def _parse_values(spec):
+    """Parses either a comma-separated list of values or an inclusive
+    range in the form of start:stop:step.
+    """
+    try:
+        if ':' in spec:
+            start, stop, step = [float(x) for x in spec.split(':')]
+            if 0 >= step:
+                raise ValueError
+            return numpy.arange(start, stop + step / 2, step)
+        return numpy.array([float(x) for x in spec.split(',')])
+    except ValueError:
+        raise Error('invalid values \'{0}\''.format(spec))
+
+
+def simulate(load, resolution, period, lo, hi, adjustment, bounds,
+        cooldown, limit):
+    """Simulates scaling of a group of instances within the specified bounds
+    for all candidates with the same period at once. Every period, the
+    average CPU utilization is compared with the thresholds of each
+    candidate and the group is scaled up or down for the next period unless
+    it is cooling down after the previous action. Returns instance-hours,
+    the share of time instances spent above the CPU utilization limit and
+    the number of scaling actions per candidate.
+    """
+    k = period // resolution
+    steps = len(load) // k
+    if 0 == steps:
+        raise Error('not enough data for a period of {0} seconds'
+            .format(period))
+    blocks = load[:steps * k].reshape(steps, k)
+    averages = blocks.mean(axis=1)
+
+    # Starts in the middle of the band of every candidate.
+    size = numpy.clip(numpy.ceil(averages[0] / ((lo + hi) / 2)), *bounds)
+    ready = numpy.zeros(len(lo), dtype=numpy.int64)
+    total = numpy.zeros(len(lo))
+    over = numpy.zeros(len(lo), dtype=numpy.int64)
+    actions = numpy.zeros(len(lo), dtype=numpy.int64)
+    wait = -(-cooldown // period)
+    for i in xrange(steps):
+        total += size
+        over += (blocks[i] > limit * size[:, numpy.newaxis]).sum(axis=1)
+        cpu = averages[i] / size
+        idle = ready <= i
+        step = numpy.where(idle & (cpu > hi), adjustment,
+            numpy.where(idle & (cpu < lo), -adjustment, 0))
+        target = numpy.clip(size + step, *bounds)
+        changed = target != size
+        actions += changed
+        ready[changed] = i + 1 + wait
+        size = target
+    return total * period / 3600.0, over / float(steps * k), actions
+
+
+def backtest(load, resolution, candidates, bounds, cooldown, limit):
+    """Simulates all candidates, which is an array of (min threshold, max
+    threshold, adjustment, period) rows, and returns arrays of results in
+    the same order.
+    """
+    hours = numpy.zeros(len(candidates))
+    over = numpy.zeros(len(candidates))
+    actions = numpy.zeros(len(candidates), dtype=numpy.int64)
+    for period in numpy.unique(candidates[:, 3]):
+        i = candidates[:, 3] == period
+        hours[i], over[i], actions[i] = simulate(load, resolution,
+            int(period), candidates[i, 0], candidates[i, 1],
+            candidates[i, 2], bounds, cooldown, limit)
+    return hours, over, actions
+
+
+def main():
+    parser = optparse.OptionParser('Usage: %prog [options] <file.csv>...')
+    parser.add_option('-c', '--cpu', dest='cpu', default=Defaults.CPU,
+        help='The name of the column with average CPU utilization. This is '
+             'set to CPUUtilization by default.')
+    parser.add_option('-r', '--requests', dest='requests',
+        help='The name of the column with the request rate, if any. If set, '
+             'the load is derived from the request rate.')
+    parser.add_option('-i', '--instances', dest='instances',
+        default=Defaults.INSTANCES, help='The number of instances CPU '
+        'utilization was measured with, or the name of the column with it. '
+        'This is set to 2 by default.')
+    parser.add_option('-m', '--min', dest='min', type='int',
+        default=Defaults.MIN_INSTANCES, help='The minimum size of the auto '
+        'scaling group. By default it is set to 2.')
+    parser.add_option('-M', '--max', dest='max', type='int',
+        default=Defaults.MAX_INSTANCES, help='The maximum size of the auto '
+        'scaling group. By default it is set to 4.')
+    parser.add_option('--min-thresholds', dest='min_thresholds',
+        default=Defaults.MIN_THRESHOLDS, help='The minimum CPU utilization '
+        'thresholds to try, either as a comma-separated list or as a range '
+        'in the form of start:stop:step. This is set to 20:50:5 by default.')
+    parser.add_option('--max-thresholds', dest='max_thresholds',
+        default=Defaults.MAX_THRESHOLDS, help='The maximum CPU utilization '
+        'thresholds to try. This is set to 50:90:5 by default.')
+    parser.add_option('-a', '--adjustments', dest='adjustments',
+        default=Defaults.ADJUSTMENTS, help='The numbers of instances to scale '
+        'up or down by to try. This is set to 1,2,3 by default.')
+    parser.add_option('-p', '--periods', dest='periods',
+        default=Defaults.PERIODS, help='The evaluation periods in seconds to '
+        'try. This is set to 60,300,600,900 by default.')
+    parser.add_option('--cooldown', dest='cooldown', type='int',
+        default=Defaults.COOLDOWN, help='The number of seconds after a '
+        'scaling action before another one can start. This is set to 300 '
+        'seconds by default.')
+    parser.add_option('-l', '--limit', dest='limit', type='float',
+        default=Defaults.LIMIT, help='The CPU utilization above which an '
+        'instance is considered overloaded. This is set to 80% by default.')
+    parser.add_option('-s', '--sort', dest='sort', default=Defaults.SORT,
+        choices=['hours', 'over', 'actions'], help='The result to sort '
+        'candidates by (hours, over or actions), with the others used to '
+        'break ties. This is set to hours by default.')
+    parser.add_option('-t', '--top', dest='top', type='int',
+        default=Defaults.TOP, help='The number of best candidates to show. '
+        'This is set to 20 by default.')
+    (opts, args) = parser.parse_args()
+
+    if (0 == len(args) or
+        1 > opts.min or
+        opts.min > opts.max or
+        0 > opts.cooldown or
+        1 > opts.top):
+        parser.print_help()
+        return 1
+
+    try:
+        series = read_series(args)
+        cpu = _find_column(series, opts.cpu)
+        if 2 > len(cpu):
+            raise Error('not enough CPU utilization data')
+        ts = sorted(cpu)
+        resolution = int(min(numpy.diff(ts)))
+        start, end = ts[0], ts[-1]
+
+        def _resample(values):
+            return resample(values, start, end, resolution)
+        try:
+            instances = float(opts.instances)
+        except ValueError:
+            instances = _resample(_find_column(series, opts.instances))
+        load = estimate_load(_resample(cpu), instances,
+            _resample(_find_column(series, opts.requests))
+                if opts.requests is not None else None)
+
+        grid = numpy.array(numpy.meshgrid(
+            _parse_values(opts.min_thresholds),
+            _parse_values(opts.max_thresholds),
+            _parse_values(opts.adjustments),
+            _parse_values(opts.periods))).reshape(4, -1).T
+        candidates = grid[(grid[:, 0] < grid[:, 1]) & (0 < grid[:, 2]) &
+            (0 < grid[:, 3])]
+        if 0 == len(candidates):
+            raise Error('no valid candidates')
+        if (candidates[:, 3] % resolution).any():
+            raise Error('periods must be multiples of {0} seconds'
+                .format(resolution))
+
+        hours, over, actions = backtest(load, resolution, candidates,
+            (opts.min, opts.max), opts.cooldown, opts.limit)
+
+        keys = {'hours': hours, 'over': over, 'actions': actions}
+        order = [keys[k] for k in ('actions', 'over', 'hours')
+            if k != opts.sort] + [keys[opts.sort]]
+        print 'Candidates: {0}, data: {1:.1f} days at {2} seconds'.format(
+            len(candidates), (end - start) / 86400.0, resolution)
+        print '{0:>8} {1:>8} {2:>10} {3:>8} {4:>14} {5:>10} {6:>8}'.format(
+            'MIN', 'MAX', 'ADJUSTMENT', 'PERIOD', 'INSTANCE-HOURS',
+            'OVERLOAD', 'ACTIONS')
+        for i in numpy.lexsort(order)[:opts.top]:
+            lo, hi, adjustment, period = candidates[i]
+            print ('{0:>8.1f} {1:>8.1f} {2:>10.0f} {3:>8.0f} {4:>14.1f} '
+                '{5:>9.2f}% {6:>8}').format(lo, hi, adjustment, period,
+                    hours[i], 100 * over[i], actions[i])
+    except Error, err:
+        sys.stderr.write('[ERROR] {0}\n'.format(err))
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
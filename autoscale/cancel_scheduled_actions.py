@@ -15,6 +15,8 @@ import boto.ec2.autoscale
 import optparse
 import sys
 
+import auto_scaling as api
+
 
 class Error(Exception):
     pass
@@ -32,8 +34,9 @@ def main():
 
     try:
         c = boto.connect_autoscale()
-        for a in c.get_all_scheduled_actions(as_group=opts.group):
-            c.delete_scheduled_action(a, opts.group)
+        for a in api.get_all(c.get_all_scheduled_actions,
+                as_group=opts.group):
+            c.delete_scheduled_action(a.name, opts.group)
     except Error, err:
         sys.stderr.write('[ERROR] {0}\n'.format(err))
         return 1
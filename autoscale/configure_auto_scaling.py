@@ -9,20 +9,33 @@ This script is intended to simplify the process of setting up AWS Auto
 Scaling to automatically manage system capacity based on average CPU
 usage of running instances.
 
+Any number of configurations can be described in a JSON or YAML spec. The
+spec is compared with the existing resources and only the ones that are
+missing or differ are created or updated. Resources that do not depend on
+each other are processed in parallel, so that setting up many
+configurations takes about as long as setting up one.
+
 Usage:
     ./configure_auto_scaling.py [options]
 """
 
 import boto.ec2.autoscale
 import boto.ec2.cloudwatch
+import boto.exception
+import collections
+import hashlib
+import json
 import optparse
+import Queue
 import sys
 
 from boto.ec2.autoscale import LaunchConfiguration
 from boto.ec2.autoscale import AutoScalingGroup
 from boto.ec2.autoscale import ScalingPolicy
 from boto.ec2.cloudwatch import MetricAlarm
+from multiprocessing.pool import ThreadPool
 
+import auto_scaling as api
 import autoscale_settings as s
 
 
@@ -41,31 +54,404 @@ class Defaults(object):
     MAX_THRESHOLD = 60
     ADJUSTMENT = 1
     PERIOD = 300
+    THREADS = 16
+
+
+Configuration = collections.namedtuple('Configuration',
+    ['name', 'image', 'type', 'key', 'group', 'zones', 'load_balancers',
+        'min', 'max', 'min_threshold', 'max_threshold', 'adjustment',
+        'period'])
+
+
+def _create_configuration(d):
+    """Creates a configuration from a dictionary, filling in defaults.
+    """
+    values = {
+        'image': Defaults.IMAGE,
+        'type': Defaults.TYPE,
+        'load_balancers': [],
+        'min': Defaults.MIN_INSTANCES,
+        'max': Defaults.MAX_INSTANCES,
+        'min_threshold': Defaults.MIN_THRESHOLD,
+        'max_threshold': Defaults.MAX_THRESHOLD,
+        'adjustment': Defaults.ADJUSTMENT,
+        'period': Defaults.PERIOD
+    }
+    values.update(d)
+    unknown = set(values) - set(Configuration._fields)
+    if unknown:
+        raise Error('unknown setting(s) {0} in \'{1}\''.format(
+            ', '.join(sorted(unknown)), values.get('name')))
+    missing = [k for k in ('name', 'key', 'group', 'zones')
+        if values.get(k) is None]
+    if missing:
+        raise Error('missing setting(s) {0} in \'{1}\''.format(
+            ', '.join(missing), values.get('name')))
+    for k in ('zones', 'load_balancers'):
+        if isinstance(values[k], basestring):
+            values[k] = [values[k]]
+    try:
+        for k in ('min', 'max', 'adjustment', 'period'):
+            values[k] = int(values[k])
+        for k in ('min_threshold', 'max_threshold'):
+            values[k] = float(values[k])
+    except (TypeError, ValueError):
+        raise Error('invalid setting \'{0}\' in \'{1}\''.format(k,
+            values['name']))
+    return Configuration(**values)
+
+
+def read_spec(path):
+    """Reads a JSON or YAML (.yaml, .yml) file. PyYAML is only required for
+    the latter.
+    """
+    try:
+        with open(path) as f:
+            data = f.read()
+    except IOError, err:
+        raise Error('could not read \'{0}\': {1}'.format(path,
+            err.strerror))
+    if path.endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError:
+            raise Error('PyYAML is required to read \'{0}\''.format(path))
+        try:
+            return yaml.safe_load(data)
+        except yaml.YAMLError, err:
+            raise Error('could not parse \'{0}\': {1}'.format(path, err))
+    try:
+        return json.loads(data)
+    except ValueError, err:
+        raise Error('could not parse \'{0}\': {1}'.format(path, err))
+
+
+def load_spec(path):
+    """Loads configurations from a JSON or YAML spec of the following form
+    (settings under defaults apply to all configurations):
+
+        defaults:
+          key: MyKeyPair
+          group: MySecurityGroup
+          zones: [us-west-1a]
+        configurations:
+          - name: TEST
+            max: 8
+    """
+    spec = read_spec(path)
+
+    if (not isinstance(spec, dict) or
+        not isinstance(spec.get('configurations'), list)):
+        raise Error('\'{0}\' does not contain a list of configurations'
+            .format(path))
+    configurations = list()
+    for c in spec['configurations']:
+        d = dict(spec.get('defaults') or {})
+        d.update(c)
+        configurations.append(_create_configuration(d))
+    names = [c.name for c in configurations]
+    if len(set(names)) != len(names):
+        raise Error('configuration names in \'{0}\' are not unique'
+            .format(path))
+    return configurations
 
 
-def _create_launch_configuration(c, opts):
-    lc = LaunchConfiguration(name=opts.name + s.LAUNCH_CONFIG_SUFFIX,
-            image_id=opts.image,
-            key_name=opts.key,
-            security_groups=[opts.group],
-            instance_type=opts.type)
-    c.create_launch_configuration(lc)
-    return lc
+State = collections.namedtuple('State',
+    ['launch_configurations', 'groups', 'policies', 'alarms'])
 
 
-def _create_autoscaling_group(c, lc, opts):
-    g = AutoScalingGroup(name=opts.name + s.GROUP_SUFFIX,
-            launch_config=lc,
-            availability_zones=opts.zones,
-            load_balancers=opts.lbs,
-            min_size=opts.min,
-            max_size=opts.max)
-    c.create_auto_scaling_group(g)
-    return g
+def _get_state(pool, configurations):
+    """Fetches all existing resources the configurations may refer to.
+    """
+    def _get_groups(names):
+        return api.get_all(api.connect()[0].get_all_groups, names=names)
+    groups = dict((g.name, g) for gs in pool.map(_get_groups,
+        api.chunks([c.name + s.GROUP_SUFFIX for c in configurations], 50))
+            for g in gs)
+
+    def _get_launch_configurations(names):
+        return api.get_all(api.connect()[0].get_all_launch_configurations,
+            names=names)
+    names = set(g.launch_config_name for g in groups.itervalues())
+    for c in configurations:
+        names.add(c.name + s.LAUNCH_CONFIG_SUFFIX)
+        names.add(_get_versioned_name(c))
+    lcs = dict((lc.name, lc) for lcs in pool.map(_get_launch_configurations,
+        api.chunks(sorted(names), 50)) for lc in lcs)
+
+    def _get_policies(name):
+        return api.get_all(api.connect()[0].get_all_policies, as_group=name)
+    policies = dict(((p.as_name, p.name), p) for ps in pool.map(_get_policies,
+        sorted(groups)) for p in ps)
+
+    def _get_alarms(names):
+        return api.get_all(api.connect()[1].describe_alarms, alarm_names=names)
+    names = [c.name + suffix for c in configurations
+        for suffix in (s.ALARM_HIGH_SUFFIX, s.ALARM_LOW_SUFFIX)]
+    alarms = dict((a.name, a) for alarms in pool.map(_get_alarms,
+        api.chunks(names, 100)) for a in alarms)
+
+    return State(lcs, groups, policies, alarms)
+
+
+class Task(object):
+    """A single change to a resource. The function is called with results
+    of all tasks done so far and returns the result of this task, which is
+    the resource name or ARN that dependent tasks refer to.
+    """
+    def __init__(self, name, action, fn, deps):
+        self.name = name
+        self.action = action
+        self.fn = fn
+        self.deps = deps
+
+
+def _get_launch_configuration_settings(c):
+    return {
+        'image_id': c.image,
+        'key_name': c.key,
+        'security_groups': [c.group],
+        'instance_type': c.type
+    }
+
+
+def _get_versioned_name(c):
+    """Returns the name of a launch configuration that replaces the
+    existing one, since launch configurations can not be changed.
+    """
+    settings = _get_launch_configuration_settings(c)
+    return '{0}{1}-{2}'.format(c.name, s.LAUNCH_CONFIG_SUFFIX,
+        hashlib.sha1(json.dumps(settings, sort_keys=True)).hexdigest()[:8])
+
+
+def _plan_launch_configuration(c, state):
+    """Returns the task that provides the launch configuration for the
+    group and the name of the launch configuration it replaces, if any.
+    """
+    settings = _get_launch_configuration_settings(c)
+    def _matches(lc):
+        return (lc is not None and
+            lc.image_id == settings['image_id'] and
+            lc.key_name == settings['key_name'] and
+            sorted(lc.security_groups) == sorted(settings['security_groups'])
+            and lc.instance_type == settings['instance_type'])
+
+    g = state.groups.get(c.name + s.GROUP_SUFFIX)
+    name = c.name + s.LAUNCH_CONFIG_SUFFIX
+    current = state.launch_configurations.get(
+        g.launch_config_name if g is not None else name)
+    if _matches(current):
+        return Task(current.name, 'unchanged', lambda r: current.name,
+            []), None
+
+    if name in state.launch_configurations:
+        name = _get_versioned_name(c)
+    old = current.name if current is not None else None
+    if _matches(state.launch_configurations.get(name)):
+        return Task(name, 'unchanged', lambda r: name, []), old
+
+    def _create(results):
+        lc = LaunchConfiguration(name=name, **settings)
+        api.call(api.connect()[0].create_launch_configuration, lc)
+        return name
+    return Task(name, 'create' if old is None else 'replace', _create,
+        []), old
+
+
+def _plan_group(c, state, lc):
+    name = c.name + s.GROUP_SUFFIX
+    g = state.groups.get(name)
+
+    if g is None:
+        def _create(results):
+            api.call(api.connect()[0].create_auto_scaling_group,
+                AutoScalingGroup(name=name,
+                    launch_config=results[lc.name],
+                    availability_zones=c.zones,
+                    load_balancers=c.load_balancers,
+                    min_size=c.min,
+                    max_size=c.max))
+            return name
+        return Task(name, 'create', _create, [lc.name])
+
+    if sorted(g.load_balancers) != sorted(c.load_balancers):
+        raise Error('load balancers of \'{0}\' can not be changed'
+            .format(name))
+    if (g.launch_config_name == lc.name and
+        sorted(g.availability_zones) == sorted(c.zones) and
+        int(g.min_size) == c.min and
+        int(g.max_size) == c.max):
+        return Task(name, 'unchanged', lambda r: name, [lc.name])
+
+    def _update(results):
+        api.call(AutoScalingGroup(connection=api.connect()[0],
+            name=name,
+            launch_config=results[lc.name],
+            availability_zones=c.zones,
+            min_size=c.min,
+            max_size=c.max,
+            desired_capacity=max(c.min, min(c.max,
+                int(g.desired_capacity)))).update)
+        return name
+    return Task(name, 'update', _update, [lc.name])
+
+
+def _plan_policy(c, state, group, suffix, adjustment):
+    name = c.name + suffix
+    p = state.policies.get((group.name, name))
+    if (p is not None and
+        int(p.scaling_adjustment) == adjustment and
+        'ChangeInCapacity' == p.adjustment_type):
+        return Task(name, 'unchanged', lambda r: p.policy_arn, [group.name])
+
+    def _put(results):
+        c = api.connect()[0]
+        api.call(c.create_scaling_policy, ScalingPolicy(name=name,
+            as_name=results[group.name],
+            scaling_adjustment=adjustment,
+            adjustment_type='ChangeInCapacity'))
+        # The ARN is needed by the alarm, but is not returned on creation.
+        ps = api.call(c.get_all_policies, as_group=results[group.name],
+            policy_names=[name])
+        if 1 != len(ps):
+            raise Error('could not find \'{0}\''.format(name))
+        return ps[0].policy_arn
+    return Task(name, 'create' if p is None else 'update', _put,
+        [group.name])
+
+
+def _plan_alarm(c, state, group, policy, suffix, threshold, comparison):
+    name = c.name + suffix
+    a = state.alarms.get(name)
+    # The ARN of a policy does not change when it is updated.
+    p = state.policies.get((group.name, policy.name))
+    settings = {
+        'metric': 'CPUUtilization',
+        'namespace': 'AWS/EC2',
+        'statistic': 'Average',
+        'dimensions': {'AutoScalingGroupName': [group.name]},
+        'period': c.period,
+        'evaluation_periods': 1,
+        'threshold': threshold,
+        'comparison': comparison
+    }
+    if (a is not None and p is not None and
+        list(a.alarm_actions) == [p.policy_arn] and
+        all(getattr(a, k) == v for k, v in settings.iteritems()
+            if 'dimensions' != k) and
+        dict(a.dimensions) == settings['dimensions']):
+        return Task(name, 'unchanged', lambda r: name, [policy.name])
+
+    def _put(results):
+        settings['dimensions'] = {'AutoScalingGroupName': results[group.name]}
+        api.call(api.connect()[1].create_alarm, MetricAlarm(name=name,
+            alarm_actions=[results[policy.name]], **settings))
+        return name
+    return Task(name, 'create' if a is None else 'update', _put,
+        [policy.name])
+
+
+def plan(c, state):
+    """Returns the tasks needed to bring the resources of a configuration
+    in line with it.
+    """
+    lc, old = _plan_launch_configuration(c, state)
+    group = _plan_group(c, state, lc)
+    up = _plan_policy(c, state, group, s.POLICY_UP_SUFFIX, c.adjustment)
+    down = _plan_policy(c, state, group, s.POLICY_DOWN_SUFFIX, -c.adjustment)
+    tasks = [lc, group, up, down,
+        _plan_alarm(c, state, group, up, s.ALARM_HIGH_SUFFIX,
+            c.max_threshold, '>'),
+        _plan_alarm(c, state, group, down, s.ALARM_LOW_SUFFIX,
+            c.min_threshold, '<')]
+    if old is not None:
+        # Only removed once the group no longer refers to it.
+        def _delete(results):
+            api.call(api.connect()[0].delete_launch_configuration, old)
+        tasks.append(Task(old, 'delete', _delete, [group.name]))
+    return tasks
+
+
+_DONE = {
+    'create': 'created',
+    'replace': 'replaced',
+    'update': 'updated',
+    'delete': 'deleted'
+}
+
+
+def execute(tasks, threads):
+    """Runs tasks as soon as all of their dependencies are done, using the
+    specified number of threads. Tasks that depend on a failed task are
+    skipped. Returns a dictionary of task names to their outcomes.
+    """
+    tasks = dict((t.name, t) for t in tasks)
+    waiting = dict((t.name, set(t.deps)) for t in tasks.itervalues())
+    dependents = collections.defaultdict(list)
+    for t in tasks.itervalues():
+        for d in t.deps:
+            dependents[d].append(t.name)
+
+    results = dict()
+    outcomes = dict()
+    done = Queue.Queue()
+    pool = ThreadPool(threads)
+
+    def _run(t):
+        try:
+            done.put((t, t.fn(results), None))
+        except Exception, err:
+            done.put((t, None, err))
+
+    def _skip(name):
+        for d in dependents[name]:
+            if d not in outcomes:
+                outcomes[d] = 'skipped'
+                print '{0}: skipped'.format(d)
+                _skip(d)
+
+    running = 0
+    for name, deps in waiting.iteritems():
+        if not deps:
+            pool.apply_async(_run, (tasks[name],))
+            running += 1
+    while 0 < running:
+        try:
+            t, result, err = done.get(timeout=1)
+        except Queue.Empty:
+            continue
+        running -= 1
+        if err is not None:
+            outcomes[t.name] = 'failed'
+            sys.stderr.write('[ERROR] {0}: {1}\n'.format(t.name,
+                getattr(err, 'error_message', None) or err))
+            _skip(t.name)
+            continue
+
+        results[t.name] = result
+        outcomes[t.name] = _DONE.get(t.action, t.action)
+        if 'unchanged' != t.action:
+            print '{0}: {1}'.format(t.name, outcomes[t.name])
+        for d in dependents[t.name]:
+            waiting[d].discard(t.name)
+            if not waiting[d] and d not in outcomes:
+                pool.apply_async(_run, (tasks[d],))
+                running += 1
+    pool.close()
+    return outcomes
+
+
+def _print_summary(outcomes):
+    counts = collections.Counter(outcomes.itervalues())
+    print ', '.join('{0} {1}'.format(n, k) for k, n in sorted(counts.items()))
 
 
 def main():
     parser = optparse.OptionParser('Usage: %prog [options]')
+    parser.add_option('-f', '--file', dest='file',
+        help='A JSON or YAML (.yaml, .yml) file with the configurations to '
+             'set up. Can be used instead of the options below to set up '
+             'many configurations at once.')
     parser.add_option('-n', '--name', dest='name',
         help='The name of this configuration (e.g., TEST).')
     parser.add_option('-i', '--image', dest='image', default=Defaults.IMAGE,
@@ -81,86 +467,90 @@ def main():
     parser.add_option('-g', '--group', dest='group',
         help='Security group that will be used when creating EC2 instances. '
              'This option is required.')
-    parser.add_option('-m', '--min', dest='min', default=Defaults.MIN_INSTANCES,
-        help='The minimum number of EC2 instances in the auto scaling group. '
-             'By default it is set to 2.')
-    parser.add_option('-M', '--max', dest='max', default=Defaults.MAX_INSTANCES,
-        help='The maximum size of the auto scaling group. By default it is '
-             'set to 4.')
+    parser.add_option('-m', '--min', dest='min', type='int',
+        default=Defaults.MIN_INSTANCES, help='The minimum number of EC2 '
+        'instances in the auto scaling group. By default it is set to 2.')
+    parser.add_option('-M', '--max', dest='max', type='int',
+        default=Defaults.MAX_INSTANCES, help='The maximum size of the auto '
+        'scaling group. By default it is set to 4.')
     parser.add_option('-z', '--zone', dest='zones', action='append',
         help='The availability zone for the auto scaling group. This option '
              'is required.')
     parser.add_option('-l', '--load-balancer', dest='lbs', action='append',
         help='The name of an existing AWS load balancer to use, if any.')
-    parser.add_option('--min-threshold', dest='min_threshold',
+    parser.add_option('--min-threshold', dest='min_threshold', type='float',
         default=Defaults.MIN_THRESHOLD, help='The minimum CPU utilization '
         'threshold that triggers an alarm. This option is not required and '
         'is set to 40% by default.')
-    parser.add_option('--max-threshold', dest='max_threshold',
+    parser.add_option('--max-threshold', dest='max_threshold', type='float',
         default=Defaults.MAX_THRESHOLD, help='The maximum CPU utilization '
         'threshold that triggers an alarm. This option is not required and '
         'is set to 60% by default.')
-    parser.add_option('-a', '--adjustment', dest='adjustment',
+    parser.add_option('-a', '--adjustment', dest='adjustment', type='int',
         default=Defaults.ADJUSTMENT, help='The number of EC2 instances by '
         'which to scale up or down. This is set to 1 by default.')
-    parser.add_option('-p', '--period', dest='period', default=Defaults.PERIOD,
-        help='The evaluation period in seconds. This is optional and is set '
-             'to 300 seconds by default.')
+    parser.add_option('-p', '--period', dest='period', type='int',
+        default=Defaults.PERIOD, help='The evaluation period in seconds. This '
+        'is optional and is set to 300 seconds by default.')
+    parser.add_option('--threads', dest='threads', type='int',
+        default=Defaults.THREADS, help='The number of resources to create or '
+        'update concurrently. This is set to 16 by default.')
+    parser.add_option('--dry-run', dest='dry_run', action='store_true',
+        help='Only show the changes that would be made.')
     (opts, args) = parser.parse_args()
 
     if (0 != len(args) or
-        opts.name is None or
-        opts.key is None or
-        opts.group is None or
-        opts.zones is None):
+        1 > opts.threads or
+        (opts.file is None and (opts.name is None or
+            opts.key is None or
+            opts.group is None or
+            opts.zones is None)) or
+        (opts.file is not None and opts.name is not None)):
         parser.print_help()
         return 1
 
     try:
-        c = boto.connect_autoscale()
-
-        lc = _create_launch_configuration(c, opts)
-        g = _create_autoscaling_group(c, lc, opts)
-
-        policy_up = ScalingPolicy(name=opts.name + s.POLICY_UP_SUFFIX,
-            as_name=g.name,
-            scaling_adjustment=opts.adjustment,
-            adjustment_type='ChangeInCapacity')
-        c.create_scaling_policy(policy_up)
-
-        cloudwatch = boto.connect_cloudwatch()
-
-        alarm_high = MetricAlarm(name=opts.name + s.ALARM_HIGH_SUFFIX,
-            alarm_actions=[policy_up],
-            metric='CPUUtilization',
-            namespace='AWS/EC2',
-            statistic='Average',
-            dimensions={'AutoScalingGroupName': g.name},
-            period=opts.period,
-            evaluation_periods=1,
-            threshold=int(opts.max_threshold),
-            comparison='>')
-        cloudwatch.create_alarm(alarm_high)
-
-        policy_down = ScalingPolicy(name=opts.name + s.POLICY_DOWN_SUFFIX,
-            as_name=g.name,
-            scaling_adjustment=-opts.adjustment,
-            adjustment_type='ChangeInCapacity')
-        autoscale.create_scaling_policy(policy_down)
-
-        alarm_low = MetricAlarm(name=opts.name + s.ALARM_LOW_SUFFIX,
-            alarm_actions=[policy_down],
-            metric='CPUUtilization',
-            namespace='AWS/EC2',
-            statistic='Average',
-            dimensions={'AutoScalingGroupName': g.name},
-            period=opts.period,
-            evaluation_periods=1,
-            threshold=int(opts.min_threshold),
-            comparison='<')
-        cloudwatch.create_alarm(alarm_low)
-    except Error, err:
-        sys.stderr.write('[ERROR] {0}\n'.format(err))
+        if opts.file is not None:
+            configurations = load_spec(opts.file)
+        else:
+            configurations = [_create_configuration({
+                'name': opts.name,
+                'image': opts.image,
+                'type': opts.type,
+                'key': opts.key,
+                'group': opts.group,
+                'zones': opts.zones,
+                'load_balancers': opts.lbs or [],
+                'min': opts.min,
+                'max': opts.max,
+                'min_threshold': opts.min_threshold,
+                'max_threshold': opts.max_threshold,
+                'adjustment': opts.adjustment,
+                'period': opts.period
+            })]
+
+        pool = ThreadPool(opts.threads)
+        state = _get_state(pool, configurations)
+        pool.close()
+
+        tasks = list()
+        for c in configurations:
+            tasks.extend(plan(c, state))
+
+        if opts.dry_run:
+            for t in tasks:
+                if 'unchanged' != t.action:
+                    print '{0}: {1}'.format(t.name, t.action)
+            _print_summary(dict((t.name, t.action) for t in tasks))
+            return 0
+
+        outcomes = execute(tasks, opts.threads)
+        _print_summary(outcomes)
+        if 'failed' in outcomes.values():
+            return 1
+    except (Error, boto.exception.BotoServerError), err:
+        sys.stderr.write('[ERROR] {0}\n'.format(
+            getattr(err, 'error_message', None) or err))
         return 1
 
     return 0
@@ -168,4 +558,3 @@ def main():
 
 if __name__ == '__main__':
     sys.exit(main())
-
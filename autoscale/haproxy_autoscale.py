@@ -7,29 +7,301 @@
 
 This tool updates backends section in haproxy configuration with a list
 of currently running EC2 instances associated with a security group and
-restarts it (zero downtime) if necessary.
+restarts it (zero downtime) if necessary. It can either run once (e.g.,
+from cron) or keep running and watch for changes.
+
+Any number of backend sections can be managed at once, each of them with
+its own security groups and/or tags. Servers are matched to instances by
+address and new ones are named after their instance IDs, so only lines of
+servers that actually changed are touched.
+
+When the haproxy stats socket is specified, instances are added and removed
+at runtime by assigning their addresses to pre-provisioned server slots and
+enabling or disabling them, so that no restart is needed unless all slots
+are taken. Slots keep their names, and the instance assigned to each of
+them is reported.
+
+New instances can optionally be probed on their service port (TCP or
+HTTP) before they are added, so that no traffic is sent to instances that
+are not ready yet. Probes run concurrently and the instances that are not
+ready are retried next time.
+
+In watch mode, Auto Scaling launch and terminate notifications can also be
+consumed from an SQS queue (either directly or through SNS) to add and
+remove instances as soon as they happen, with periodic polling as a safety
+net.
 
 Usage:
     ./haproxy_autoscale.py <options>
 """
 
 import boto.ec2
+import boto.sqs
+import errno
+import json
 import optparse
 import os
+import random
 import re
+import select
+import socket
 import subprocess
 import sys
 import time
 
+from boto.sqs.message import RawMessage
+from multiprocessing.pool import ThreadPool
+
+
+class Error(Exception):
+    pass
+
+
+class Event(object):
+    """Represents an Auto Scaling membership event.
+    """
+    LAUNCH = 'launch'
+    TERMINATE = 'terminate'
+
+
+class Defaults(object):
+    """Default settings.
+    """
+    CONFIG = '/etc/haproxy/haproxy.cfg'
+    INTERVAL = 10
+    DEBOUNCE = 30
+    MAX_BACKOFF = 300
+    SLOTS = 10
+    PLACEHOLDER = '0.0.0.0'
+    WAIT_TIME = 20
+    INDENT = '    '
+    OPTIONS = ' check'
+    CHECK_TIMEOUT = 2
+    RESOLVE_THREADS = 32
+    # The number of seconds to keep terminating instances out, which is the
+    # default timeout of lifecycle hooks.
+    TERMINATING_TTL = 3600
+
+
+class Section(object):
+    """Represents a section header line of haproxy configuration.
+    """
+    def __init__(self, kind, name, text):
+        self.kind = kind
+        self.name = name
+        self.text = text
+
+    def render(self):
+        return self.text
+
+
+class Server(object):
+    """Represents a server line of haproxy configuration. The original
+    text is kept until the server changes.
+    """
+    def __init__(self, indent, name, address, options, text=None):
+        self.indent = indent
+        self.name = name
+        self.address = address
+        self.options = options
+        self.text = text
+
+    @property
+    def enabled(self):
+        return 'disabled' not in self.options.split()
+
+    def update(self, address, enabled):
+        self.address = address
+        self.options = _enable(self.options)
+        if not enabled:
+            self.options += ' disabled'
+        self.text = None
+
+    def render(self):
+        if self.text is not None:
+            return self.text
+        return '{0}server {1} {2}{3}\n'.format(self.indent, self.name,
+            self.address, self.options)
+
+
+def _enable(options):
+    return re.sub(r'\s+disabled\b', '', options)
+
+
+def _render(item):
+    return item if isinstance(item, str) else item.render()
+
+
+class Config(object):
+    """Parsed haproxy configuration. Lines other than section headers and
+    servers are kept as they are.
+    """
+    SECTION = re.compile(r'^(global|defaults|frontend|backend|listen|'
+        r'userlist|peers|resolvers|mailers|program|cache)\b\s*(\S*)')
+    SERVER = re.compile(r'^(\s+)server\s+(\S+)\s+([^\s:]+)(.*?)\n?$')
+
+    def __init__(self, path):
+        self.path = path
+        self.items = list()
+        with open(path) as f:
+            for line in f:
+                p = self.SECTION.match(line)
+                if p:
+                    self.items.append(Section(p.group(1), p.group(2), line))
+                    continue
+                p = self.SERVER.match(line)
+                if p:
+                    self.items.append(Server(*(p.groups() + (line,))))
+                else:
+                    self.items.append(line)
+        self.original = self.render()
 
-def _get_running_instances(groups):
-    """Retrieves a list of currently running EC2 instances that belong
-    to the specified security groups.
+    def get_backends(self):
+        return [x.name for x in self.items
+            if isinstance(x, Section) and x.kind in ('backend', 'listen')]
+
+    def get_servers(self, backend):
+        start, end = self._find(backend)
+        return [x for x in self.items[start:end] if isinstance(x, Server)]
+
+    def get_addresses(self, backend):
+        return set(s.address for s in self.get_servers(backend) if s.enabled)
+
+    def add_server(self, backend, server):
+        """Adds a server after the last one of the section, or after the
+        last non-empty line of the section if there are no servers yet.
+        """
+        start, end = self._find(backend)
+        pos = start
+        for i in xrange(start, end):
+            if _render(self.items[i]).strip():
+                pos = i
+        if not _render(self.items[pos]).endswith('\n'):
+            pos += 1
+            self.items.insert(pos, '\n')
+        self.items.insert(pos + 1, server)
+
+    def remove_server(self, server):
+        self.items.remove(server)
+
+    def render(self):
+        return ''.join(_render(x) for x in self.items)
+
+    def save(self):
+        """Saves the configuration keeping a backup of the previous one.
+        Returns False if nothing has changed.
+        """
+        data = self.render()
+        if data == self.original:
+            return False
+        os.rename(self.path, self.path + time.strftime('.%Y%m%d%H%M%S',
+            time.gmtime()))
+        _save_file(self.path, data)
+        self.original = data
+        return True
+
+    def _find(self, backend):
+        """Returns the range of items that belong to the backend section.
+        """
+        start = None
+        for i, x in enumerate(self.items):
+            if not isinstance(x, Section):
+                continue
+            if start is not None:
+                return start, i
+            if x.kind in ('backend', 'listen') and x.name == backend:
+                start = i
+        if start is None:
+            raise Error('could not find backend \'{0}\''.format(backend))
+        return start, len(self.items)
+
+
+def _parse_filters(spec):
+    """Parses a comma-separated list of security group IDs and tags (e.g.,
+    sg-012345ab,tag:Role=web) into EC2 filters.
+    """
+    filters = {'instance-state-name': 'running'}
+    for item in spec.split(','):
+        item = item.strip()
+        if item.startswith('tag:') and '=' in item:
+            key, value = item.split('=', 1)
+            filters.setdefault(key, list()).append(value)
+        elif item:
+            filters.setdefault('instance.group-id', list()).append(item)
+    if 1 == len(filters):
+        raise Error('invalid backend filter \'{0}\''.format(spec))
+    return filters
+
+
+def _matches(instance, filters):
+    """Checks if an instance matches filters created by _parse_filters.
+    """
+    for key, values in filters.iteritems():
+        if 'instance-state-name' == key:
+            if instance.state not in values:
+                return False
+        elif 'instance.group-id' == key:
+            if not set(g.id for g in instance.groups) & set(values):
+                return False
+        elif instance.tags.get(key[4:]) not in values:
+            return False
+    return True
+
+
+def _get_address(instance, ip):
+    """Returns the private IP address of an instance if requested, since
+    the runtime API needs them, or its private DNS name otherwise.
+    """
+    return instance.private_ip_address if ip else instance.private_dns_name
+
+
+def _get_running_instances(c, backends, ip=False):
+    """Retrieves currently running EC2 instances for every backend as a
+    dict of addresses by instance ID. Backends that use the same filters
+    share a single request.
     """
-    c = boto.connect_ec2()
-    return [i.private_dns_name for i in c.get_only_instances(filters={
-                'instance.group-id': groups,
-                'instance-state-name': 'running'})]
+    cache = dict()
+    members = dict()
+    for name, filters in backends.iteritems():
+        key = repr(sorted(filters.items()))
+        if key not in cache:
+            cache[key] = dict((i.id, _get_address(i, ip))
+                for i in c.get_only_instances(filters=filters))
+        members[name] = dict(cache[key])
+    return members
+
+
+def _get_launched_instances(c, backends, ids, ip=False):
+    """Retrieves the specified instances if they are running and returns
+    them for every backend they belong to.
+    """
+    instances = c.get_only_instances(instance_ids=ids,
+        filters={'instance-state-name': 'running'})
+    return dict((name, dict((i.id, _get_address(i, ip))
+        for i in instances if _matches(i, filters)))
+            for name, filters in backends.iteritems())
+
+
+def _parse_event(body):
+    """Returns an (event, instance ID) tuple from an Auto Scaling
+    notification or lifecycle hook message, possibly wrapped by SNS.
+    Returns None for messages that do not affect membership.
+    """
+    try:
+        doc = json.loads(body)
+        if 'Notification' == doc.get('Type'):
+            doc = json.loads(doc['Message'])
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+    if not isinstance(doc, dict) or not doc.get('EC2InstanceId'):
+        return None
+
+    event = doc.get('Event') or doc.get('LifecycleTransition') or ''
+    if event.startswith('autoscaling:EC2_INSTANCE_LAUNCH'):
+        return Event.LAUNCH, doc['EC2InstanceId']
+    if event.startswith('autoscaling:EC2_INSTANCE_TERMINAT'):
+        return Event.TERMINATE, doc['EC2InstanceId']
+    return None
 
 
 def _read_file(path):
@@ -64,42 +336,503 @@ def _restart_haproxy(config):
     return 0
 
 
+class RuntimeApi(object):
+    """Sends commands to haproxy over its stats socket, which has to be
+    configured with the admin level. The socket is opened by _connect(),
+    so that a fake one can be used instead.
+    """
+    ERRORS = re.compile(r'^(No such|Unknown|Require|Permission denied|'
+        r'Invalid|.*failed)', re.MULTILINE)
+
+    def __init__(self, path):
+        self.path = path
+
+    def execute(self, commands):
+        s = self._connect()
+        try:
+            s.sendall('; '.join(commands) + '\n')
+            data = list()
+            while True:
+                chunk = s.recv(4096)
+                if not chunk:
+                    break
+                data.append(chunk)
+        finally:
+            s.close()
+
+        out = ''.join(data)
+        m = self.ERRORS.search(out)
+        if m:
+            raise Error('haproxy: {0}'.format(out[m.start():].split('\n')[0]))
+        return out
+
+    def _connect(self):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(self.path)
+        except socket.error:
+            s.close()
+            raise
+        return s
+
+
+def _is_instance_id(name):
+    return re.match(r'^i-[0-9a-f]+$', name) is not None
+
+
+def _plan_slots(servers, addresses, runtime):
+    """Decides how the servers of a backend change to serve the specified
+    addresses without changing them. Returns a tuple of (server, address)
+    tuples of servers that get a new address, addresses that need new
+    servers, and servers that are removed. Servers keep their addresses as
+    long as they are wanted. In runtime mode, new addresses are assigned
+    to free slots, starting with the ones of removed servers, but servers
+    named after instance IDs are never reused for other instances.
+    """
+    kept = set()
+    removed = list()
+    free = list()
+    for s in servers:
+        if s.enabled and s.address in addresses and s.address not in kept:
+            kept.add(s.address)
+        elif s.enabled:
+            removed.append(s)
+        elif runtime and not _is_instance_id(s.name):
+            free.append(s)
+
+    # Slots that are taken by removed instances can be reused right away.
+    if runtime:
+        free = [s for s in removed if not _is_instance_id(s.name)] + free
+
+    assigned = list()
+    added = list()
+    for address in sorted(addresses):
+        if address in kept:
+            continue
+        if runtime and free:
+            s = free.pop(0)
+            if s in removed:
+                removed.remove(s)
+            assigned.append((s, address))
+        else:
+            added.append(address)
+    return assigned, added, removed
+
+
+def _get_runtime_commands(backend, assigned, removed):
+    """Returns the runtime API commands that apply a plan returned by
+    _plan_slots() before it is applied to the servers.
+    """
+    commands = list()
+    for s, address in assigned:
+        if s.enabled:
+            commands.append('set server {0}/{1} state maint'
+                .format(backend, s.name))
+        commands.append('set server {0}/{1} addr {2}'
+            .format(backend, s.name, address))
+        commands.append('set server {0}/{1} state ready'
+            .format(backend, s.name))
+    for s in removed:
+        commands.append('set server {0}/{1} state maint'
+            .format(backend, s.name))
+        commands.append('set server {0}/{1} addr {2}'
+            .format(backend, s.name, Defaults.PLACEHOLDER))
+    return commands
+
+
+def _sync_backend(config, backend, members, runtime, spare):
+    """Brings servers of a backend in the configuration in line with the
+    specified members as planned by _plan_slots(). In runtime mode, the
+    commands to apply the changes are returned, and servers named after
+    instance IDs that were disabled are dropped on the next restart.
+    Returns None if a restart is needed.
+    """
+    servers = config.get_servers(backend)
+    wanted = dict((a, i) for i, a in members.iteritems())
+    options = _enable(servers[0].options) if servers else Defaults.OPTIONS
+    indent = servers[0].indent if servers else Defaults.INDENT
+
+    assigned, added, removed = _plan_slots(servers, wanted, runtime)
+    commands = _get_runtime_commands(backend, assigned, removed) \
+        if runtime else list()
+
+    for s, address in assigned:
+        s.update(address, True)
+        sys.stdout.write('{0}/{1}: {2} ({3})\n'.format(backend, s.name,
+            wanted[address], address))
+    for address in added:
+        config.add_server(backend, Server(indent, wanted[address], address,
+            options))
+    for s in removed:
+        if runtime:
+            s.update(Defaults.PLACEHOLDER, False)
+        else:
+            config.remove_server(s)
+
+    if runtime and added:
+        for s in config.get_servers(backend):
+            if not s.enabled and _is_instance_id(s.name):
+                config.remove_server(s)
+        # Provision spare slots to be used at runtime after the restart.
+        servers = config.get_servers(backend)
+        names = set(s.name for s in servers)
+        n = 0
+        for _ in xrange(max(0, spare - sum(1 for s in servers
+                if not s.enabled))):
+            while 'slot{0}'.format(n) in names:
+                n += 1
+            names.add('slot{0}'.format(n))
+            config.add_server(backend, Server(indent, 'slot{0}'.format(n),
+                Defaults.PLACEHOLDER, options + ' disabled'))
+
+    return None if added else commands
+
+
+def _resolve(addresses):
+    """Returns a dictionary of addresses to their IP addresses, or None for
+    the ones that could not be resolved. Names are resolved concurrently,
+    since lookups block.
+    """
+    def _lookup(address):
+        try:
+            return address, socket.gethostbyname(address)
+        except socket.error:
+            return address, None
+    names = [a for a in addresses if not re.match(r'^[\d.]+$', a)]
+    ips = dict((a, a) for a in addresses if a not in names)
+    if names:
+        pool = ThreadPool(min(len(names), Defaults.RESOLVE_THREADS))
+        try:
+            ips.update(pool.map(_lookup, names))
+        finally:
+            pool.close()
+    return ips
+
+
+def _probe(addresses, port, path, timeout):
+    """Returns the addresses that accept connections on the specified port
+    and, if a path is specified, respond to an HTTP GET with a 2xx or 3xx
+    status. Names are resolved concurrently and all probes run concurrently
+    on non-blocking sockets, so they take about a single timeout
+    altogether.
+    """
+    request = 'GET {0} HTTP/1.0\r\nConnection: close\r\n\r\n'.format(path)
+    poller = select.poll()
+    probes = dict()
+    for address, ip in _resolve(set(addresses)).iteritems():
+        if ip is None:
+            continue
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setblocking(0)
+        try:
+            err = s.connect_ex((ip, port))
+        except socket.error:
+            err = errno.EHOSTUNREACH
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            s.close()
+            continue
+        probes[s.fileno()] = [s, address, '']
+        poller.register(s, select.POLLOUT)
+
+    ready = set()
+    deadline = time.time() + timeout
+    while probes:
+        remaining = deadline - time.time()
+        if 0 >= remaining:
+            break
+        for fd, event in poller.poll(remaining * 1000):
+            s, address, data = probes[fd]
+            done = True
+            if s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                pass
+            elif path is None:
+                ready.add(address)
+            elif event & select.POLLOUT:
+                try:
+                    s.sendall(request)
+                    poller.modify(s, select.POLLIN)
+                    done = False
+                except socket.error:
+                    pass
+            else:
+                try:
+                    chunk = s.recv(1024)
+                except socket.error:
+                    chunk = ''
+                data += chunk
+                if chunk and '\n' not in data:
+                    probes[fd][2] = data
+                    done = False
+                elif re.match(r'HTTP/1\.\d [23]\d\d', data):
+                    ready.add(address)
+            if done:
+                poller.unregister(s)
+                s.close()
+                del probes[fd]
+
+    for s, _, _ in probes.itervalues():
+        s.close()
+    return ready
+
+
+def _get_ready_members(opts, config, members):
+    """Leaves out new members that are not ready to receive traffic yet.
+    """
+    if opts.check_port is None:
+        return members
+    new = set(a for b, m in members.iteritems() for a in m.itervalues()
+        if a not in config.get_addresses(b))
+    if not new:
+        return members
+    ready = _probe(new, opts.check_port, opts.check_path, opts.check_timeout)
+    return dict((b, dict((i, a) for i, a in m.iteritems()
+        if a in ready or a not in new)) for b, m in members.iteritems())
+
+
+def update(opts, config, members):
+    """Brings haproxy in line with the specified members of every backend
+    and saves the configuration. Changes are applied through the runtime
+    API if possible and haproxy gets restarted otherwise. Returns False
+    if there was nothing to change.
+    """
+    members = _get_ready_members(opts, config, members)
+    runtime = opts.socket is not None
+    commands = list()
+    restart = False
+    for backend in sorted(members):
+        c = _sync_backend(config, backend, members[backend], runtime,
+            opts.slots)
+        if c is None:
+            restart = True
+        else:
+            commands.extend(c)
+
+    if not config.save():
+        return False
+    if runtime and not restart:
+        try:
+            if commands:
+                RuntimeApi(opts.socket).execute(commands)
+            return True
+        except (Error, socket.error), err:
+            sys.stderr.write('[ERROR] {0}\n'.format(err))
+    _restart_haproxy(opts.config)
+    return True
+
+
+def _get_state(config, members):
+    """Returns sets of addresses by backend for the specified members and
+    for the servers in the configuration.
+    """
+    return (dict((b, set(m.itervalues())) for b, m in members.iteritems()),
+        dict((b, config.get_addresses(b)) for b in members))
+
+
+def _jitter(seconds):
+    """Spreads out polling of multiple instances of this tool.
+    """
+    return seconds * random.uniform(0.8, 1.2)
+
+
+class Watcher(object):
+    """Keeps haproxy in line with running instances. Instances are polled
+    periodically and a change is applied right away, after which further
+    changes are merged and held back for the debounce window, so that
+    there is at most one restart per window. Membership events from a
+    queue, if any, are applied as soon as they arrive. Errors, including
+    the ones from updating haproxy, are logged and retried with exponential
+    backoff.
+    """
+    def __init__(self, opts, config, backends):
+        self.opts = opts
+        self.config = config
+        self.backends = backends
+        self.ip = opts.socket is not None
+        self.ec2 = boto.connect_ec2()
+        self.queue = None
+        if opts.queue is not None:
+            self.queue = boto.connect_sqs().get_queue(opts.queue)
+            if self.queue is None:
+                raise Error('could not find \'{0}\''.format(opts.queue))
+            self.queue.set_message_class(RawMessage)
+        self.members = None
+        # Instances that are being terminated are still running while their
+        # lifecycle hooks wait, so they are kept out until they stop.
+        self.terminating = dict()
+        self.restarted = 0
+        self.failures = 0
+        self.next_poll = 0
+
+    def run(self):
+        while True:
+            try:
+                if self.next_poll <= time.time():
+                    self.next_poll = time.time() + _jitter(self.opts.interval)
+                    self.poll()
+                if self.queue is not None:
+                    self.receive(self.next_poll - time.time())
+                else:
+                    time.sleep(max(0, self.next_poll - time.time()))
+                self.failures = 0
+            except Exception, err:
+                self.failures += 1
+                sys.stderr.write('[ERROR] {0}\n'.format(err))
+                time.sleep(_jitter(min(self.opts.interval * 2 ** self.failures,
+                    Defaults.MAX_BACKOFF)))
+
+    def poll(self):
+        """Reconciles membership with all running instances.
+        """
+        members = _get_running_instances(self.ec2, self.backends, self.ip)
+        now = time.time()
+        for id, expires in self.terminating.items():
+            if now >= expires or not any(id in m
+                    for m in members.itervalues()):
+                del self.terminating[id]
+            else:
+                for m in members.itervalues():
+                    m.pop(id, None)
+        self.members = members
+        new, current = _get_state(self.config, self.members)
+        if new == current:
+            return
+        # The first change is applied at once, and the ones that follow
+        # within the window are applied together once it is over.
+        wait = self.restarted + self.opts.debounce - time.time()
+        if 0 >= wait:
+            self._apply()
+        else:
+            self.next_poll = time.time() + wait
+
+    def receive(self, timeout):
+        """Receives membership events for up to the specified number of
+        seconds and applies them right away.
+        """
+        messages = self.queue.get_messages(num_messages=10,
+            wait_time_seconds=int(max(0, min(Defaults.WAIT_TIME, timeout))))
+        launched = set()
+        terminated = set()
+        for m in messages:
+            e = _parse_event(m.get_body())
+            if e is None:
+                continue
+            if Event.LAUNCH == e[0]:
+                launched.add(e[1])
+                self.terminating.pop(e[1], None)
+            else:
+                launched.discard(e[1])
+                terminated.add(e[1])
+                self.terminating[e[1]] = time.time() + \
+                    Defaults.TERMINATING_TTL
+
+        if self.members is not None and (launched or terminated):
+            members = dict((b, dict(m)) for b, m in self.members.iteritems())
+            for m in members.itervalues():
+                for i in terminated:
+                    m.pop(i, None)
+            if launched:
+                for b, m in _get_launched_instances(self.ec2, self.backends,
+                        list(launched), self.ip).iteritems():
+                    members[b].update(m)
+            if members != self.members:
+                self.members = members
+                self._apply()
+
+        if messages:
+            self.queue.delete_message_batch(messages)
+
+    def _apply(self):
+        if update(self.opts, self.config, self.members):
+            self.restarted = time.time()
+
+
+def _get_backends(opts, config):
+    """Returns EC2 filters by backend name. Security groups specified with
+    --group apply to the last backend section of the configuration.
+    """
+    backends = dict()
+    for spec in opts.backends or list():
+        name, _, filters = spec.partition('=')
+        config.get_servers(name)
+        backends[name] = _parse_filters(filters)
+    if opts.groups is not None:
+        names = config.get_backends()
+        if not names:
+            raise Error('could not find backend section')
+        backends[names[-1]] = _parse_filters(','.join(opts.groups))
+    return backends
+
+
 def main():
     parser = optparse.OptionParser('Usage: %prog <options>')
     parser.add_option('-c', '--config', dest='config',
-        default='/etc/haproxy/haproxy.cfg',
+        default=Defaults.CONFIG,
         help='HAProxy configuration file to use.')
     parser.add_option('-g', '--group', dest='groups', action='append',
-        help='The ID of a security group.')
+        help='The ID of a security group for the last backend section.')
+    parser.add_option('-b', '--backend', dest='backends', action='append',
+        help='A backend section and a comma-separated list of security group '
+             'IDs and tags to select its instances with (e.g., '
+             'web=sg-012345ab,tag:Role=web). Can be specified multiple times.')
+    parser.add_option('-w', '--watch', dest='watch', action='store_true',
+        help='Keep running and watch for changes instead of updating the '
+             'configuration once.')
+    parser.add_option('-i', '--interval', dest='interval', type='float',
+        default=Defaults.INTERVAL, help='The number of seconds between '
+        'checks in watch mode. This is set to 10 seconds by default.')
+    parser.add_option('-d', '--debounce', dest='debounce', type='float',
+        default=Defaults.DEBOUNCE, help='The minimum number of seconds '
+        'between updates in watch mode. Changes within that time are merged '
+        'and applied together. This is set to 30 seconds by default.')
+    parser.add_option('-s', '--socket', dest='socket',
+        help='The haproxy stats socket to apply changes through without '
+             'restarting. It must be configured with the admin level.')
+    parser.add_option('--slots', dest='slots', type='int',
+        default=Defaults.SLOTS, help='The number of spare server slots to '
+        'provision for runtime changes whenever haproxy has to be restarted. '
+        'This is set to 10 by default.')
+    parser.add_option('-q', '--queue', dest='queue',
+        help='An SQS queue that receives Auto Scaling launch and terminate '
+             'notifications to react to in watch mode.')
+    parser.add_option('--check-port', dest='check_port', type='int',
+        help='The port to probe new instances on before adding them. New '
+             'instances are not probed by default.')
+    parser.add_option('--check-path', dest='check_path',
+        help='The HTTP path to request when probing new instances. Only a '
+             'TCP connection is attempted by default.')
+    parser.add_option('--check-timeout', dest='check_timeout', type='float',
+        default=Defaults.CHECK_TIMEOUT, help='The number of seconds to wait '
+        'for probes. This is set to 2 seconds by default.')
     (opts, args) = parser.parse_args()
 
-    if 0 != len(args) or opts.groups is None:
+    if (0 != len(args) or
+        (opts.groups is None and opts.backends is None) or
+        (opts.queue is not None and not opts.watch)):
         parser.print_help()
         return 1
 
-    config = list()
-    old = set()
-    with open(opts.config) as f:
-        for line in f:
-            p = re.match(r'[^#](\s+)server(\s+)(\w+)(\s+)([^\s:]+)(.*)', line)
-            if p:
-                old.add(p.groups()[4])
-            else:
-                config.append(line)
+    try:
+        config = Config(opts.config)
+        backends = _get_backends(opts, config)
 
-    new = _get_running_instances(opts.groups)
-    if sorted(new) != sorted(old):
-        for pp, item in enumerate(new):
-            config.append('    server app{0} {1} check\n'.format(pp, item))
+        if opts.watch:
+            try:
+                Watcher(opts, config, backends).run()
+            except KeyboardInterrupt:
+                pass
+            return 0
 
-        os.rename(opts.config, opts.config + time.strftime('.%Y%m%d%H%M%S',
-            time.gmtime()))
-        _save_file(opts.config, config)
-        _restart_haproxy(opts.config)
+        members = _get_running_instances(boto.connect_ec2(), backends,
+            opts.socket is not None)
+        new, current = _get_state(config, members)
+        if new != current:
+            update(opts, config, members)
+    except Error, err:
+        sys.stderr.write('[ERROR] {0}\n'.format(err))
+        return 1
 
     return 0
 
 
 if __name__ == '__main__':
     sys.exit(main())
-
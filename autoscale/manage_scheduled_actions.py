@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+# Copyright (c) 2014 Eugene Zhuk.
+# Use of this source code is governed by the MIT license that can be found
+# in the LICENSE file.
+
+"""Manages scheduled actions.
+
+Selects auto scaling groups by name, regular expression and/or tags, and
+either cancels their scheduled actions or brings them in line with a JSON
+or YAML schedule. Actions can be narrowed down by name and time window, so
+that only a part of the schedule of every group is touched. Changes are
+made concurrently under a shared rate limit.
+
+Usage:
+    ./manage_scheduled_actions.py [options]
+"""
+
+import boto.ec2.autoscale
+import boto.exception
+import collections
+import datetime
+import optparse
+import re
+import sys
+import time
+
+from multiprocessing.pool import ThreadPool
+
+import auto_scaling as api
+import configure_auto_scaling as cas
+
+
+class Error(Exception):
+    pass
+
+
+class Defaults(object):
+    """Default settings.
+    """
+    THREADS = 16
+    RATE = 10
+    TIME_FORMATS = ['%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S',
+        '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d']
+
+
+def _parse_time(value):
+    """Parses a UTC time, unless YAML has already done so.
+    """
+    if isinstance(value, datetime.datetime):
+        return value.replace(tzinfo=None)
+    if isinstance(value, datetime.date):
+        return datetime.datetime(value.year, value.month, value.day)
+    for f in Defaults.TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(str(value), f)
+        except ValueError:
+            pass
+    raise Error('invalid time \'{0}\''.format(value))
+
+
+Action = collections.namedtuple('Action',
+    ['name', 'start_time', 'end_time', 'recurrence', 'min_size', 'max_size',
+        'desired_capacity'])
+
+
+def _to_action(a):
+    """Converts a scheduled action returned by the API.
+    """
+    def _int(value):
+        return int(value) if value is not None else None
+    return Action(a.name, a.start_time, a.end_time, a.recurrence,
+        _int(a.min_size), _int(a.max_size), _int(a.desired_capacity))
+
+
+def load_schedule(path):
+    """Loads scheduled actions from a JSON or YAML file of the following
+    form. Settings that are left out are not compared with existing
+    actions (e.g., the start time of recurring actions, which is reported
+    as the time of their next occurrence).
+
+        actions:
+          - name: holiday-scale-up
+            start_time: 2014-12-24T00:00:00Z
+            end_time: 2014-12-27T00:00:00Z
+            min_size: 4
+            max_size: 16
+          - name: nightly-scale-down
+            recurrence: 0 2 * * *
+            desired_capacity: 2
+    """
+    spec = cas.read_spec(path)
+
+    if (not isinstance(spec, dict) or
+        not isinstance(spec.get('actions'), list)):
+        raise Error('\'{0}\' does not contain a list of actions'
+            .format(path))
+    actions = list()
+    for d in spec['actions']:
+        unknown = set(d) - set(Action._fields)
+        if unknown:
+            raise Error('unknown setting(s) {0} in \'{1}\''.format(
+                ', '.join(sorted(unknown)), d.get('name')))
+        if d.get('name') is None:
+            raise Error('missing action name in \'{0}\''.format(path))
+        values = dict((k, d.get(k)) for k in Action._fields)
+        for k in ('start_time', 'end_time'):
+            if values[k] is not None:
+                values[k] = _parse_time(values[k])
+        try:
+            for k in ('min_size', 'max_size', 'desired_capacity'):
+                if values[k] is not None:
+                    values[k] = int(values[k])
+        except (TypeError, ValueError):
+            raise Error('invalid setting \'{0}\' in \'{1}\''.format(k,
+                values['name']))
+        actions.append(Action(**values))
+    names = [a.name for a in actions]
+    if len(set(names)) != len(names):
+        raise Error('action names in \'{0}\' are not unique'.format(path))
+    return actions
+
+
+def _diff(current, desired):
+    """Returns a list of (setting, current value, desired value) tuples of
+    the settings that differ. Settings that are not desired are ignored.
+    """
+    return [(k, getattr(current, k) if current is not None else None, v)
+        for k, v in desired._asdict().iteritems()
+            if 'name' != k and v is not None and
+                (current is None or v != getattr(current, k))]
+
+
+def _format_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.strftime(Defaults.TIME_FORMATS[0])
+    return value
+
+
+def select_groups(pool, names, regex, tags):
+    """Returns the names of groups that have one of the specified names (or
+    any name, if none), match the regular expression and have all of the
+    specified tags.
+    """
+    c = api.connect()[0]
+    if names:
+        def _get(names):
+            return api.get_all(api.connect()[0].get_all_groups, names=names)
+        groups = [g for gs in pool.map(_get, api.chunks(names, 50))
+            for g in gs]
+        missing = set(names) - set(g.name for g in groups)
+        if missing:
+            raise Error('could not find {0}'.format(', '.join(
+                '\'{0}\''.format(n) for n in sorted(missing))))
+    else:
+        groups = api.get_all(c.get_all_groups, max_records=100)
+    return sorted(g.name for g in groups
+        if (regex is None or regex.search(g.name)) and
+            all(any(t.key == k and t.value == v for t in g.tags)
+                for k, v in tags))
+
+
+def get_actions(pool, groups, regex, start, end):
+    """Returns a dictionary of group names to dictionaries of their
+    scheduled actions by name, fetching all pages. The time window is
+    applied server-side.
+    """
+    def _get(group):
+        actions = api.get_all(api.connect()[0].get_all_scheduled_actions,
+            as_group=group, start_time=start, end_time=end)
+        return group, dict((a.name, _to_action(a)) for a in actions
+            if regex is None or regex.search(a.name))
+    return dict(pool.map(_get, groups))
+
+
+def plan(current, desired):
+    """Returns a sorted list of (change, group, action, settings) tuples,
+    where the change is one of create, update or delete, and the settings
+    are the ones that change as returned by _diff(). If there is no desired
+    schedule, all current actions are deleted.
+    """
+    changes = list()
+    for group, actions in current.iteritems():
+        for a in desired or []:
+            diff = _diff(actions.get(a.name), a)
+            if a.name not in actions:
+                changes.append(('create', group, a, diff))
+            elif diff:
+                changes.append(('update', group, a, diff))
+        names = set(a.name for a in desired or [])
+        for name, a in actions.iteritems():
+            if name not in names:
+                changes.append(('delete', group, a, []))
+    return sorted(changes, key=lambda x: (x[1], x[2].name))
+
+
+def apply_changes(pool, changes, limiter):
+    """Applies changes concurrently and returns the number of failures.
+    """
+    def _apply(change):
+        kind, group, a, _ = change
+        c = api.connect()[0]
+        limiter.acquire()
+        try:
+            if 'delete' == kind:
+                api.call(c.delete_scheduled_action, a.name, group)
+            else:
+                api.call(c.create_scheduled_group_action, group, a.name,
+                    start_time=a.start_time,
+                    end_time=a.end_time,
+                    recurrence=a.recurrence,
+                    min_size=a.min_size,
+                    max_size=a.max_size,
+                    desired_capacity=a.desired_capacity)
+        except Exception, err:
+            sys.stderr.write('[ERROR] {0}: {1}: {2}\n'.format(group, a.name,
+                getattr(err, 'error_message', None) or err))
+            return False
+        # Written at once, since print is not atomic across threads.
+        sys.stdout.write('{0}: {1} {2}d\n'.format(group, a.name, kind))
+        return True
+    return pool.map(_apply, changes).count(False)
+
+
+def main():
+    parser = optparse.OptionParser('Usage: %prog [options]')
+    parser.add_option('-g', '--group', dest='groups', action='append',
+        help='The name of an auto scaling group. Can be specified multiple '
+             'times. All groups are selected by default.')
+    parser.add_option('-e', '--regex', dest='regex',
+        help='Select groups whose names match this regular expression.')
+    parser.add_option('--tag', dest='tags', action='append',
+        help='Select groups that have this tag (e.g., Environment=test). '
+             'Can be specified multiple times.')
+    parser.add_option('-n', '--name', dest='name',
+        help='Only touch scheduled actions whose names match this regular '
+             'expression.')
+    parser.add_option('--after', dest='after',
+        help='Only touch scheduled actions that start at or after this UTC '
+             'time (e.g., 2014-12-20T00:00:00Z).')
+    parser.add_option('--before', dest='before',
+        help='Only touch scheduled actions that start at or before this UTC '
+             'time.')
+    parser.add_option('-f', '--file', dest='file',
+        help='A JSON or YAML file with the scheduled actions every selected '
+             'group should have. Actions that are not in it are deleted. If '
+             'not specified, all selected actions are deleted.')
+    parser.add_option('-t', '--threads', dest='threads', type='int',
+        default=Defaults.THREADS, help='The number of concurrent requests. '
+        'This is set to 16 by default.')
+    parser.add_option('-r', '--rate', dest='rate', type='float',
+        default=Defaults.RATE, help='The maximum number of changes per '
+        'second. This is set to 10 by default, 0 disables the limit.')
+    parser.add_option('--dry-run', dest='dry_run', action='store_true',
+        help='Only show the changes that would be made.')
+    (opts, args) = parser.parse_args()
+
+    if (0 != len(args) or
+        (opts.groups is None and opts.regex is None and opts.tags is None) or
+        1 > opts.threads or
+        0 > opts.rate):
+        parser.print_help()
+        return 1
+
+    try:
+        tags = list()
+        for t in opts.tags or []:
+            k, sep, v = t.partition('=')
+            if not sep:
+                raise Error('invalid tag \'{0}\''.format(t))
+            tags.append((k, v))
+        regex = re.compile(opts.regex) if opts.regex is not None else None
+        name = re.compile(opts.name) if opts.name is not None else None
+        start = _parse_time(opts.after) if opts.after is not None else None
+        end = _parse_time(opts.before) if opts.before is not None else None
+
+        desired = None
+        if opts.file is not None:
+            desired = load_schedule(opts.file)
+            for a in desired:
+                # Otherwise they would never be found and created every time.
+                if name is not None and not name.search(a.name):
+                    raise Error('\'{0}\' does not match \'{1}\''.format(
+                        a.name, opts.name))
+                # The same goes for actions outside of the time window, which
+                # includes the ones without a start time.
+                if ((start is not None or end is not None) and
+                    (a.start_time is None or
+                        (start is not None and a.start_time < start) or
+                        (end is not None and a.start_time > end))):
+                    raise Error('\'{0}\' does not start within the time '
+                        'window'.format(a.name))
+
+        pool = ThreadPool(opts.threads)
+        groups = select_groups(pool, opts.groups, regex, tags)
+        if not groups:
+            raise Error('could not find any matching groups')
+        changes = plan(get_actions(pool, groups, name, start, end), desired)
+
+        if opts.dry_run:
+            for kind, group, a, diff in changes:
+                print '{0} {1}: {2}'.format({'create': '+', 'update': '~',
+                    'delete': '-'}[kind], group, a.name)
+                for k, old, new in diff:
+                    if 'create' == kind:
+                        print '    {0}: {1}'.format(k, _format_value(new))
+                    else:
+                        print '    {0}: {1} -> {2}'.format(k,
+                            _format_value(old), _format_value(new))
+        elif apply_changes(pool, changes, api.RateLimiter(opts.rate)):
+            return 1
+        counts = collections.Counter(kind for kind, _, _, _ in changes)
+        print 'Groups: {0}, creates: {1}, updates: {2}, deletes: {3}'.format(
+            len(groups), counts['create'], counts['update'],
+            counts['delete'])
+    except (Error, cas.Error, re.error), err:
+        sys.stderr.write('[ERROR] {0}\n'.format(err))
+        return 1
+    except boto.exception.BotoServerError, err:
+        sys.stderr.write('[ERROR] {0}\n'.format(err.error_message or err))
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
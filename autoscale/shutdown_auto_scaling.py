@@ -8,64 +8,186 @@
 This allows for easy shutdown of previously created AWS Auto Scaling
 configuration.
 
+Any number of configurations can be shut down at once. Groups are scaled
+in concurrently once their alarms and scaling policies are deleted, all of
+them are watched with a single request per check, and each group and its
+launch configuration are deleted as soon as its instances are gone.
+
 Usage:
     ./shutdown_auto_scaling.py <options>
 """
 
 import boto.ec2.autoscale
 import boto.ec2.cloudwatch
+import boto.exception
 import optparse
 import sys
 import time
 
+from multiprocessing.pool import ThreadPool
+
 import autoscale_settings as s
+import auto_scaling as api
+import configure_auto_scaling as cas
 
 
 class Error(Exception):
     pass
 
 
+class Defaults(object):
+    """Default settings.
+    """
+    THREADS = 16
+    MIN_DELAY = 2
+    MAX_DELAY = 30
+
+
+def _get_message(err):
+    return getattr(err, 'error_message', None) or err
+
+
+def _run(pool, fn, items):
+    """Calls the function for all items in parallel and returns the items it
+    failed for, printing errors along the way.
+    """
+    def _safe(item):
+        try:
+            fn(item)
+        except Exception, err:
+            sys.stderr.write('[ERROR] {0}: {1}\n'.format(item,
+                _get_message(err)))
+            return item
+    return [x for x in pool.map(_safe, items) if x is not None]
+
+
+def _get_groups(pool, names):
+    """Fetches the specified groups with one request per 50 groups.
+    """
+    def _get(names):
+        return api.get_all(api.connect()[0].get_all_groups, names=names)
+    return dict((g.name, g) for gs in pool.map(_get, api.chunks(names, 50))
+        for g in gs)
+
+
+def _delete_alarms(pool, names):
+    def _get(names):
+        return api.get_all(api.connect()[1].describe_alarms,
+            alarm_names=names)
+    alarms = [a.name for alarms in pool.map(_get, api.chunks(names, 100))
+        for a in alarms]
+    for chunk in api.chunks(alarms, 100):
+        api.call(api.connect()[1].delete_alarms, chunk)
+
+
+def _scale_in(g):
+    """Deletes scaling policies of the group and scales it in to zero.
+    """
+    c = api.connect()[0]
+    for p in api.get_all(c.get_all_policies, as_group=g.name):
+        api.call(c.delete_policy, p.name, g.name)
+    # The fetched group is updated, since the update has to include its
+    # launch configuration and availability zones.
+    g.connection = c
+    g.min_size = 0
+    g.max_size = 0
+    g.desired_capacity = 0
+    api.call(g.update)
+
+
+def _delete_group(g):
+    c = api.connect()[0]
+    api.call(c.delete_auto_scaling_group, g.name)
+    # The group may have used a replaced launch configuration.
+    api.call(c.delete_launch_configuration, g.launch_config_name)
+
+
+def shutdown(pool, names):
+    """Shuts down the specified configurations and returns the names of the
+    ones that failed.
+    """
+    groups = _get_groups(pool, [n + s.GROUP_SUFFIX for n in names])
+    failed = set()
+    for n in names:
+        if n + s.GROUP_SUFFIX not in groups:
+            sys.stderr.write('[ERROR] could not find \'{0}\'\n'.format(
+                n + s.GROUP_SUFFIX))
+            failed.add(n)
+    names = [n for n in names if n not in failed]
+
+    # Alarms go first, so that they do not trigger scaling up meanwhile.
+    _delete_alarms(pool, [n + suffix for n in names
+        for suffix in (s.ALARM_HIGH_SUFFIX, s.ALARM_LOW_SUFFIX)])
+    for g in _run(pool, lambda g: _scale_in(groups[g]),
+            [n + s.GROUP_SUFFIX for n in names]):
+        failed.add(g[:-len(s.GROUP_SUFFIX)])
+
+    # Watches all groups at once and deletes each one as soon as it is
+    # empty, backing off while nothing changes.
+    pending = set(n + s.GROUP_SUFFIX for n in names if n not in failed)
+    deletions = list()
+    delay = Defaults.MIN_DELAY
+    left = None
+    while pending:
+        time.sleep(delay)
+        groups = _get_groups(pool, sorted(pending))
+        for name in sorted(pending):
+            g = groups.get(name)
+            if g is None or not g.instances:
+                pending.discard(name)
+                if g is not None:
+                    deletions.append((name, pool.apply_async(_delete_group,
+                        (g,))))
+        n = sum(len(g.instances) for g in groups.itervalues())
+        if n != left:
+            print '{0} instance(s) left in {1} group(s)'.format(n,
+                len(pending))
+            delay = Defaults.MIN_DELAY
+        else:
+            delay = min(delay * 2, Defaults.MAX_DELAY)
+        left = n
+
+    for name, r in deletions:
+        try:
+            r.get()
+            print '{0}: deleted'.format(name[:-len(s.GROUP_SUFFIX)])
+        except Exception, err:
+            sys.stderr.write('[ERROR] {0}: {1}\n'.format(name,
+                _get_message(err)))
+            failed.add(name[:-len(s.GROUP_SUFFIX)])
+    return failed
+
+
 def main():
     parser = optparse.OptionParser('Usage: %prog <options>')
-    parser.add_option('-n', '--name', dest='name',
-        help='The name of the configuration to shutdown (e.g., TEST).')
+    parser.add_option('-n', '--name', dest='names', action='append',
+        help='The name of the configuration to shutdown (e.g., TEST). Can '
+             'be specified multiple times.')
+    parser.add_option('-f', '--file', dest='file',
+        help='A JSON or YAML spec as accepted by configure_auto_scaling.py '
+             'with the configurations to shutdown.')
+    parser.add_option('-t', '--threads', dest='threads', type='int',
+        default=Defaults.THREADS, help='The number of concurrent requests. '
+        'This is set to 16 by default.')
     (opts, args) = parser.parse_args()
 
-    if 0 != len(args) or opts.name is None:
+    if (0 != len(args) or
+        (opts.names is None and opts.file is None) or
+        1 > opts.threads):
         parser.print_help()
         return 1
 
     try:
-        c = boto.connect_autoscale()
-
-        group_name = opts.name + s.GROUP_SUFFIX
-        gs = c.get_all_groups(names=[group_name])
-        if len(gs) != 1:
-            raise Error('could not find \'{0}\''.format(group_name))
-
-        g = gs[0]
-        g.min_size = 0
-        g.max_size = 0
-        g.desired_capacity = 0
-        g.update()
-
-        g.shutdown_instances()
-        while True:
-            g = c.get_all_groups(names=[group_name])[0]
-            if not g.instances:
-                break
-            time.sleep(1)
-
-        c.delete_policy(opts.name + s.POLICY_UP_SUFFIX)
-        c.delete_policy(opts.name + s.POLICY_DOWN_SUFFIX)
-        c.delete_auto_scaling_group(group_name)
-        c.delete_launch_configuration(opts.name + s.LAUNCH_CONFIG_SUFFIX)
-
-        cw = boto.connect_cloudwatch()
-        cw.delete_alarms([opts.name + s.ALARM_HIGH_SUFFIX,
-            opts.name + s.ALARM_LOW_SUFFIX])
-    except Error, err:
-        sys.stderr.write('[ERROR] {0}\n'.format(err))
+        names = list(opts.names or [])
+        if opts.file is not None:
+            names.extend(c.name for c in cas.load_spec(opts.file))
+        names = sorted(set(names))
+
+        pool = ThreadPool(opts.threads)
+        if shutdown(pool, names):
+            return 1
+    except (Error, cas.Error, boto.exception.BotoServerError), err:
+        sys.stderr.write('[ERROR] {0}\n'.format(_get_message(err)))
         return 1
 
     return 0
@@ -73,4 +195,3 @@ def main():
 
 if __name__ == '__main__':
     sys.exit(main())
-
@@ -15,6 +15,9 @@ import boto.ec2
 import optparse
 import sys
 
+import resource_selection
+import status_waiter
+
 
 class Error(Exception):
     pass
@@ -24,20 +27,42 @@ def main():
     parser = optparse.OptionParser('Usage: %prog [options]')
     parser.add_option('-i', '--image', dest='images', action='append',
         help='One or more AMI IDs to check the status for.')
+    status_waiter.add_options(parser, False)
+    resource_selection.add_options(parser)
     (opts, args) = parser.parse_args()
 
-    if 0 != len(args) or opts.images is None:
+    if (0 != len(args) or
+        (opts.images is None and not resource_selection.is_selected(opts))):
         parser.print_help()
         return 1
 
     try:
         c = boto.connect_ec2()
-        images = c.get_all_images(image_ids=opts.images)
-        if not images:
-            raise Error('could not find \'{0}\''.format(opts.images))
-
-        for i in images:
-            print '{0}: {1}'.format(i.id, i.state)
+        reporter = status_waiter.JsonReporter() if opts.json else None
+        waiter = status_waiter.Waiter(
+            lambda ids: c.get_all_images(image_ids=ids),
+            lambda i: i.state,
+            ['pending', 'transient'],
+            reporter=reporter,
+            failed=['failed', 'invalid', 'error'])
+        if resource_selection.is_selected(opts):
+            filters = resource_selection.parse_filters(opts.tags,
+                opts.filters)
+            ids = resource_selection.get_ids(opts, opts.images)
+            # Public images are only included if selected by ID.
+            owners = ['self'] if ids is None else None
+            missing = list()
+            pending = waiter.stream(resource_selection.select(
+                # Images are not paginated, so every chunk is a single page.
+                lambda f: [c.get_all_images(owners=owners, filters=f)],
+                'image-id', ids, filters, missing))
+            resource_selection.check_found(missing)
+            if opts.wait and pending:
+                waiter.wait(pending)
+        else:
+            waiter.wait(status_waiter.create_targets(opts.images), opts.wait)
+        if 0 != waiter.failures:
+            return 1
     except (Error, Exception), err:
         sys.stderr.write('[ERROR] {0}\n'.format(err))
         return 1
@@ -7,44 +7,167 @@
 
 Displays the current status of one or more EC2 Instances.
 
+Only the specified instances are fetched, in chunks of IDs passed as
+server-side filters, and all regions are searched in parallel. Instances
+can also be selected by tags and filters, or by IDs read from a file, and
+are written out (optionally as JSON lines) page by page as they arrive.
+System and instance status checks can optionally be shown as well.
+
 Usage:
     ./check_instance_status.py <options>
 """
 
 import boto.ec2
-import itertools
+import json
 import optparse
 import sys
 
+from multiprocessing.pool import ThreadPool
+
+import resource_selection
+
 
 class Error(Exception):
     pass
 
 
+class Defaults(object):
+    """Default settings.
+    """
+    THREADS = 16
+    # The maximum number of filter values and instance IDs per request.
+    FILTER_SIZE = 200
+    STATUS_SIZE = 100
+    # The number of chunks of IDs to look up at once.
+    BATCH_SIZE = 16
+
+
+def _get_statuses(region, instances):
+    """Returns a dictionary of instance IDs to their status checks.
+    """
+    c = resource_selection.connect(region)
+    ids = [i.id for i in instances]
+    statuses = dict()
+    for chunk in resource_selection.chunks(ids, Defaults.STATUS_SIZE):
+        next_token = None
+        while True:
+            rs = c.get_all_instance_status(instance_ids=chunk,
+                include_all_instances=True, next_token=next_token)
+            statuses.update((s.id, s) for s in rs)
+            next_token = rs.next_token
+            if not next_token:
+                break
+    return statuses
+
+
+def _get_pages(region, filters, checks):
+    """Yields pages of (region, instance, status) tuples of the instances
+    that match the filters in the specified region.
+    """
+    c = resource_selection.connect(region)
+    next_token = None
+    while True:
+        # Instance IDs are passed as a filter, so pages can be requested.
+        rs = c.get_all_reservations(filters=filters,
+            max_results=resource_selection.Defaults.PAGE_SIZE,
+            next_token=next_token)
+        instances = [i for r in rs for i in r.instances]
+        statuses = _get_statuses(region, instances) if checks else dict()
+        yield [(region, i, statuses.get(i.id)) for i in instances]
+        next_token = rs.next_token
+        if not next_token:
+            return
+
+
+def get_instances(pool, regions, ids, filters, checks):
+    """Yields pages of (region, instance, status) tuples of the selected
+    instances in all regions as they arrive. IDs are read in batches, so
+    that only a few of them are held in memory at a time.
+    """
+    def _task(region, f):
+        return lambda: _get_pages(region, f, checks)
+    if ids is None:
+        tasks = [_task(r, filters) for r in regions]
+        for page in resource_selection.stream_pages(pool, tasks):
+            yield page
+        return
+    for batch in resource_selection.chunks(resource_selection.chunks(ids,
+            Defaults.FILTER_SIZE), Defaults.BATCH_SIZE):
+        tasks = list()
+        for chunk in batch:
+            f = dict(filters)
+            f['instance-id'] = chunk
+            tasks.extend(_task(r, f) for r in regions)
+        for page in resource_selection.stream_pages(pool, tasks):
+            yield page
+
+
+def _format(region, i, status, as_json):
+    if as_json:
+        return json.dumps({
+            'id': i.id,
+            'region': region,
+            'state': i.state,
+            'system': status.system_status.status if status else None,
+            'instance': status.instance_status.status if status else None
+        }, sort_keys=True)
+    if status is not None:
+        return '{0}: {1} ({2}, system: {3}, instance: {4})'.format(i.id,
+            i.state, region, status.system_status.status,
+            status.instance_status.status)
+    return '{0}: {1} ({2})'.format(i.id, i.state, region)
+
+
 def main():
     parser = optparse.OptionParser('Usage: %prog [options]')
     parser.add_option('-i', '--instance', dest='instances', action='append',
         help='One or more EC2 Instances to check the status for.')
+    parser.add_option('-r', '--region', dest='regions', action='append',
+        help='The name of the region to look for instances in. All regions '
+             'are searched by default.')
+    parser.add_option('-c', '--checks', dest='checks', action='store_true',
+        help='Also show the results of system and instance status checks.')
+    parser.add_option('-j', '--json', dest='json', action='store_true',
+        help='Write the status of every instance as a line of JSON.')
+    parser.add_option('-t', '--threads', dest='threads', type='int',
+        default=Defaults.THREADS, help='The number of concurrent requests. '
+        'This is set to 16 by default.')
+    resource_selection.add_options(parser)
     (opts, args) = parser.parse_args()
 
-    if 0 != len(args) or opts.instances is None:
+    if (0 != len(args) or
+        (opts.instances is None and
+            not resource_selection.is_selected(opts)) or
+        1 > opts.threads):
         parser.print_help()
         return 1
 
     try:
-        c = boto.connect_ec2()
-        instances = list(itertools.chain.from_iterable(r.instances
-            for r in c.get_all_reservations()))
-        if not instances:
-            raise Error('could not find \'{0}\''.format(opts.instances))
-
-        for i in instances:
-            print '{0}: {1}'.format(i.id, i.state)
+        filters = resource_selection.parse_filters(opts.tags, opts.filters)
+        ids = resource_selection.get_ids(opts, opts.instances)
+        pool = ThreadPool(opts.threads)
+        regions = resource_selection.get_regions(opts.regions)
+
+        # Only IDs given as options are checked, since the others may be
+        # too many to keep track of.
+        wanted = set(opts.instances or [])
+        found = set()
+        for page in get_instances(pool, regions, ids, filters, opts.checks):
+            sys.stdout.write(''.join(_format(region, i, status, opts.json) +
+                '\n' for region, i, status in page))
+            sys.stdout.flush()
+            found.update(i.id for _, i, _ in page if i.id in wanted)
+
+        missing = sorted(wanted - found)
+        if missing and not filters:
+            raise Error('could not find {0}'.format(', '.join(
+                '\'{0}\''.format(id) for id in missing)))
     except (Error, Exception), err:
         sys.stderr.write('[ERROR] {0}\n'.format(err))
         return 1
 
+    return 0
+
 
 if __name__ == '__main__':
     sys.exit(main())
-
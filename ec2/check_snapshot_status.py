@@ -5,7 +5,9 @@
 
 """Checks AWS EBS Snapshot status.
 
-This script displays the current status of one or more AWS EBS snapshots.
+This script displays the current status of one or more AWS EBS snapshots
+and waits until none of them is pending, along with the estimated time
+left for each of them.
 
 Usage:
     ./check_snapshot_status.py [options]
@@ -14,44 +16,63 @@ Usage:
 import boto.ec2
 import optparse
 import sys
-import time
+
+from boto.ec2.snapshot import Snapshot
+
+import resource_selection
+import status_waiter
 
 
 class Error(Exception):
     pass
 
 
+def _get_progress(snap):
+    return int(snap.progress.strip('%')) if snap.progress else None
+
+
 def main():
     parser = optparse.OptionParser('Usage: %prog [options]')
     parser.add_option('-s', '--snapshot', dest='snapshots', action='append',
-        help='The snapshot ID(s) to check status for. This option is required.')
+        help='One or more snapshot IDs to check the status for.')
+    status_waiter.add_options(parser, True)
+    resource_selection.add_options(parser)
     (opts, args) = parser.parse_args()
 
-    if 0 != len(args) or opts.snapshots is None:
+    if (0 != len(args) or
+        (opts.snapshots is None and not resource_selection.is_selected(opts))):
         parser.print_help()
         return 1
 
     try:
         c = boto.connect_ec2()
-        while True:
-            snapshots = c.get_all_snapshots(snapshot_ids=opts.snapshots)
-            if not snapshots:
-                raise Error('could not find \'{0}\''.format(opts.snapshots))
-
-            for snap in snapshots:
-                print '{0}: [{1}{2}] {3}'.format(snap.id,
-                    '#' * 4 * (int(snap.progress.strip('%')) / 10),
-                    ' ' * 4 * ((100 - int(snap.progress.strip('%'))) / 10),
-                    snap.progress)
-
-            if all(snap.status != 'pending' for snap in snapshots):
-                break
-
-            size = len(snapshots)
-            if (1 < size):
-                sys.stdout.write('\x1b[1A' * size)
-
-            time.sleep(3)
+        reporter = status_waiter.JsonReporter() if opts.json else None
+        waiter = status_waiter.Waiter(
+            lambda ids: c.get_all_snapshots(snapshot_ids=ids),
+            lambda snap: snap.status,
+            ['pending'],
+            _get_progress,
+            reporter,
+            failed=['error'])
+        if resource_selection.is_selected(opts):
+            filters = resource_selection.parse_filters(opts.tags,
+                opts.filters)
+            ids = resource_selection.get_ids(opts, opts.snapshots)
+            # Public snapshots are only included if selected by ID.
+            params = {'Owner.1': 'self'} if ids is None else None
+            missing = list()
+            pending = waiter.stream(resource_selection.select(
+                lambda f: resource_selection.describe_pages(c,
+                    'DescribeSnapshots', Snapshot, f, params),
+                'snapshot-id', ids, filters, missing))
+            resource_selection.check_found(missing)
+            if opts.wait and pending:
+                waiter.wait(pending)
+        else:
+            waiter.wait(status_waiter.create_targets(opts.snapshots),
+                opts.wait)
+        if 0 != waiter.failures:
+            return 1
     except (Error, Exception), err:
         sys.stderr.write('[ERROR] {0}\n'.format(err))
         return 1
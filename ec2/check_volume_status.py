@@ -15,6 +15,11 @@ import boto.ec2
 import optparse
 import sys
 
+from boto.ec2.volume import Volume
+
+import resource_selection
+import status_waiter
+
 
 class Error(Exception):
     pass
@@ -24,20 +29,40 @@ def main():
     parser = optparse.OptionParser('Usage: %prog [options]')
     parser.add_option('-v', '--volume', dest='volumes', action='append',
         help='One or more EBS Volumes to check the status for.')
+    status_waiter.add_options(parser, False)
+    resource_selection.add_options(parser)
     (opts, args) = parser.parse_args()
 
-    if 0 != len(args) or opts.volumes is None:
+    if (0 != len(args) or
+        (opts.volumes is None and not resource_selection.is_selected(opts))):
         parser.print_help()
         return 1
 
     try:
         c = boto.connect_ec2()
-        volumes = c.get_all_volumes(volume_ids=opts.volumes)
-        if not volumes:
-            raise Error('could not find \'{0}\''.format(opts.volumes))
-
-        for v in volumes:
-            print '{0}: {1}'.format(v.id, v.status)
+        reporter = status_waiter.JsonReporter() if opts.json else None
+        waiter = status_waiter.Waiter(
+            lambda ids: c.get_all_volumes(volume_ids=ids),
+            lambda v: v.status,
+            ['creating', 'deleting'],
+            reporter=reporter,
+            failed=['error'])
+        if resource_selection.is_selected(opts):
+            filters = resource_selection.parse_filters(opts.tags,
+                opts.filters)
+            ids = resource_selection.get_ids(opts, opts.volumes)
+            missing = list()
+            pending = waiter.stream(resource_selection.select(
+                lambda f: resource_selection.describe_pages(c,
+                    'DescribeVolumes', Volume, f),
+                'volume-id', ids, filters, missing))
+            resource_selection.check_found(missing)
+            if opts.wait and pending:
+                waiter.wait(pending)
+        else:
+            waiter.wait(status_waiter.create_targets(opts.volumes), opts.wait)
+        if 0 != waiter.failures:
+            return 1
     except (Error, Exception), err:
         sys.stderr.write('[ERROR] {0}\n'.format(err))
         return 1
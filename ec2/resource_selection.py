@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# Copyright (c) 2014 Eugene Zhuk.
+# Use of this source code is governed by the MIT license that can be found
+# in the LICENSE file.
+
+"""Selects EC2 resources.
+
+Resources are selected by IDs (given as options or read from a file, one
+or more per line), tags and/or arbitrary EC2 filters, all of which are
+applied server-side. Results are fetched page by page and IDs are read in
+chunks, so that any number of resources can be processed as a stream with
+bounded memory. Connections and the list of regions to search are shared
+by the scripts that look in more than one region.
+"""
+
+import boto.ec2
+import itertools
+import Queue
+import sys
+import threading
+
+
+class Error(Exception):
+    pass
+
+
+class Defaults(object):
+    """Default settings.
+    """
+    # The maximum number of values per filter.
+    CHUNK_SIZE = 200
+    PAGE_SIZE = 1000
+    QUEUE_SIZE = 16
+
+
+_local = threading.local()
+
+
+def connect(region):
+    """Returns a connection to the specified region that belongs to the
+    calling thread, since connections can not be shared between threads.
+    """
+    if not hasattr(_local, 'connections'):
+        _local.connections = dict()
+    if region not in _local.connections:
+        _local.connections[region] = boto.ec2.connect_to_region(region)
+    return _local.connections[region]
+
+
+def get_regions(regions):
+    if regions is not None:
+        return [r.name for r in boto.ec2.regions() if r.name in regions]
+    else:
+        return [r.name for r in boto.ec2.regions()
+            if not r.name.startswith(('us-gov-', 'cn-'))]
+
+
+def add_options(parser):
+    parser.add_option('--tag', dest='tags', action='append',
+        help='Select resources that have this tag (e.g., Environment=test '
+             'or Environment=test,stage for any of the values). Can be '
+             'specified multiple times.')
+    parser.add_option('--filter', dest='filters', action='append',
+        help='Select resources that match this EC2 filter (e.g., '
+             'availability-zone=us-east-1a). Can be specified multiple '
+             'times.')
+    parser.add_option('--ids-from', dest='ids_from', metavar='FILE',
+        help='Read the IDs of resources to select from this file, or from '
+             'standard input if it is -.')
+
+
+def is_selected(opts):
+    return bool(opts.tags or opts.filters or opts.ids_from is not None)
+
+
+def parse_filters(tags, filters):
+    """Returns a dictionary of EC2 filter names to lists of values.
+    """
+    result = dict()
+    for prefix, specs in (('tag:', tags or []), ('', filters or [])):
+        for spec in specs:
+            name, sep, values = spec.partition('=')
+            if not sep or not name:
+                raise Error('invalid filter \'{0}\''.format(spec))
+            result.setdefault(prefix + name, list()).extend(
+                values.split(','))
+    return result
+
+
+def read_ids(f):
+    """Yields IDs from a file that contains one or more of them per line.
+    """
+    for line in f:
+        for id in line.split():
+            yield id
+
+
+def get_ids(opts, ids):
+    """Returns an iterator over the IDs given as options and read from the
+    file specified by --ids-from, or None if there are neither.
+    """
+    if opts.ids_from is None:
+        return iter(ids) if ids else None
+    if '-' == opts.ids_from:
+        f = sys.stdin
+    else:
+        try:
+            f = open(opts.ids_from)
+        except IOError, err:
+            raise Error('could not read \'{0}\': {1}'.format(opts.ids_from,
+                err.strerror))
+    return itertools.chain(ids or [], read_ids(f))
+
+
+def chunks(items, size=Defaults.CHUNK_SIZE):
+    """Yields lists of up to the specified number of items from an iterator
+    without reading it all.
+    """
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def select(describe, id_filter, ids, filters, missing=None):
+    """Yields pages of resources. The describe function takes filters and
+    yields pages of the resources that match them. If IDs are specified,
+    they are added as a filter in chunks, and the ones that match nothing
+    are appended to the missing list, if any, unless other filters are
+    specified, since those may rule them out.
+    """
+    if ids is None:
+        for page in describe(filters):
+            yield page
+        return
+    for chunk in chunks(ids):
+        f = dict(filters)
+        f[id_filter] = chunk
+        found = set()
+        for page in describe(f):
+            found.update(x.id for x in page)
+            yield page
+        if missing is not None and not filters:
+            missing.extend(id for id in chunk if id not in found)
+
+
+def check_found(missing):
+    """Raises an error if any of the IDs were not found.
+    """
+    if missing:
+        raise Error('could not find {0}'.format(', '.join(
+            '\'{0}\''.format(id) for id in missing)))
+
+
+def describe_pages(c, action, cls, filters, params=None):
+    """Yields pages of resources returned by the specified describe action
+    (e.g., DescribeVolumes) of an EC2 connection.
+    """
+    params = dict(params or {})
+    params['MaxResults'] = Defaults.PAGE_SIZE
+    c.build_filter_params(params, filters)
+    while True:
+        rs = c.get_list(action, params, [('item', cls)], verb='POST')
+        yield rs
+        if not rs.next_token:
+            return
+        params['NextToken'] = rs.next_token
+
+
+def stream_pages(pool, tasks):
+    """Runs functions that yield pages concurrently and yields the pages in
+    the order they arrive. Only a few pages are buffered at a time.
+    """
+    q = Queue.Queue(Defaults.QUEUE_SIZE)
+    done = object()
+    def _run(task):
+        try:
+            for page in task():
+                q.put((page, None))
+        except Exception, err:
+            q.put((None, err))
+        q.put((done, None))
+
+    n = 0
+    for t in tasks:
+        pool.apply_async(_run, (t,))
+        n += 1
+    while 0 < n:
+        page, err = q.get()
+        if err is not None:
+            raise err
+        if page is done:
+            n -= 1
+        else:
+            yield page
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# Copyright (c) 2014 Eugene Zhuk.
+# Use of this source code is governed by the MIT license that can be found
+# in the LICENSE file.
+
+"""Waits for EC2 resources.
+
+Polls any number of resources (e.g., snapshots, images or volumes) with a
+single batched describe request per check until all of them reach a final
+state. The interval between checks adapts to the observed progress, and
+the time left is estimated for every resource that reports its progress.
+Status is either redrawn in place on a terminal or written as JSON lines.
+Resources can also be reported as they are listed, so that only the ones
+that are still in transitional states need to be waited for.
+"""
+
+import boto.exception
+import collections
+import datetime
+import json
+import re
+import sys
+import time
+
+import resource_selection
+
+
+class Error(Exception):
+    pass
+
+
+class Defaults(object):
+    """Default settings.
+    """
+    MIN_INTERVAL = 2
+    MAX_INTERVAL = 60
+    BACKOFF = 1.5
+    # The number of checks to make before the earliest expected completion.
+    CHECKS = 4
+    BATCH_SIZE = 200
+    BAR_WIDTH = 40
+
+
+def add_options(parser, wait):
+    """Adds the options shared by the scripts that wait for resources. The
+    argument is whether to wait by default.
+    """
+    parser.add_option('-w', '--wait', dest='wait', action='store_true',
+        default=wait, help='Wait until none of them is in a transitional '
+        'state.{0}'.format(' This is the default.' if wait else ''))
+    parser.add_option('--no-wait', dest='wait', action='store_false',
+        help='Only show the current status instead of waiting.{0}'.format(
+            '' if wait else ' This is the default.'))
+    parser.add_option('-j', '--json', dest='json', action='store_true',
+        help='Write status changes as lines of JSON.')
+
+
+class Target(object):
+    """Tracks the state and progress of a single resource.
+    """
+    def __init__(self, id):
+        self.id = id
+        self.state = None
+        self.progress = None
+        self.eta = None
+        self.first = None
+
+    def update(self, now, state, progress):
+        """Updates the state and progress (in percent, if known) and returns
+        whether either of them changed.
+        """
+        changed = state != self.state or progress != self.progress
+        self.state = state
+        self.progress = progress
+        if progress is None:
+            self.eta = None
+        elif self.first is None:
+            self.first = (now, progress)
+        elif progress > self.first[1] and now > self.first[0]:
+            # The average rate since the resource was first seen.
+            rate = (progress - self.first[1]) / (now - self.first[0])
+            self.eta = (100 - progress) / rate
+        return changed
+
+
+def _format_eta(seconds):
+    m, s = divmod(int(seconds), 60)
+    h, m = divmod(m, 60)
+    if 0 != h:
+        return '{0}h {1:02}m'.format(h, m)
+    return '{0}m {1:02}s'.format(m, s)
+
+
+def format_target(t):
+    if t.progress is None:
+        line = '{0}: {1}'.format(t.id, t.state)
+    else:
+        done = int(t.progress * Defaults.BAR_WIDTH / 100)
+        line = '{0}: [{1}{2}] {3}% {4}'.format(t.id, '#' * done,
+            ' ' * (Defaults.BAR_WIDTH - done), int(t.progress), t.state)
+    if t.eta is not None and t.progress < 100:
+        line += ' (ETA {0})'.format(_format_eta(t.eta))
+    return line
+
+
+class TerminalReporter(object):
+    """Redraws the status of all resources in place if the output is a
+    terminal, and prints lines of the ones that changed otherwise.
+    """
+    def __init__(self, out=sys.stdout):
+        self.out = out
+        self.tty = out.isatty()
+        self.lines = 0
+
+    def report(self, targets, changed):
+        if self.tty:
+            # Moves up to the first line and clears every line it rewrites.
+            self.out.write('\x1b[{0}A'.format(self.lines) if self.lines
+                else '')
+            self.out.write(''.join('\x1b[K{0}\n'.format(format_target(t))
+                for t in targets))
+            self.lines = len(targets)
+        else:
+            self.out.write(''.join('{0}\n'.format(format_target(t))
+                for t in changed))
+        self.out.flush()
+
+    def write(self, t):
+        self.out.write('{0}\n'.format(format_target(t)))
+        self.out.flush()
+
+
+class JsonReporter(object):
+    """Writes an event for every change as a line of JSON.
+    """
+    def __init__(self, out=sys.stdout):
+        self.out = out
+
+    def _format(self, t, now):
+        return json.dumps({
+            'time': now,
+            'id': t.id,
+            'state': t.state,
+            'progress': t.progress,
+            'eta': int(t.eta) if t.eta is not None else None
+        }, sort_keys=True) + '\n'
+
+    def report(self, targets, changed):
+        now = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+        self.out.write(''.join(self._format(t, now) for t in changed))
+        self.out.flush()
+
+    def write(self, t):
+        self.out.write(self._format(t,
+            datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')))
+        self.out.flush()
+
+
+def create_targets(ids):
+    return [Target(id) for id in collections.OrderedDict.fromkeys(ids)]
+
+
+class Waiter(object):
+    """Waits for resources to leave transitional states. The describe
+    function takes a list of IDs and returns the resources found, while the
+    state and progress functions extract those from a single resource. The
+    progress function is optional and returns a number between 0 and 100
+    or None if unknown. Resources that end up in one of the failed states
+    are counted as failures.
+    """
+    def __init__(self, describe, get_state, transitional, get_progress=None,
+            reporter=None, failed=()):
+        self.describe = describe
+        self.get_state = get_state
+        self.transitional = transitional
+        self.get_progress = get_progress or (lambda x: None)
+        self.reporter = reporter or TerminalReporter()
+        self.failed = failed
+        self.failures = 0
+
+    def stream(self, pages):
+        """Reports resources as pages of them arrive and returns targets
+        of the ones that are in transitional states.
+        """
+        pending = list()
+        for page in pages:
+            now = time.time()
+            for x in page:
+                t = Target(x.id)
+                t.update(now, self.get_state(x), self.get_progress(x))
+                self.reporter.write(t)
+                if t.state in self.transitional:
+                    pending.append(t)
+                elif t.state in self.failed:
+                    self.failures += 1
+        return pending
+
+    def _describe(self, ids):
+        """Returns the resources found, leaving out the ones that EC2 reports
+        as not found instead of failing the whole request.
+        """
+        try:
+            return list(self.describe(ids))
+        except boto.exception.EC2ResponseError, err:
+            if not (err.error_code or '').endswith('.NotFound'):
+                raise
+            message = err.error_message or ''
+            missing = [id for id in ids
+                if re.search(r'\b{0}\b'.format(re.escape(id)), message)]
+            if missing:
+                rest = [id for id in ids if id not in missing]
+                return self._describe(rest) if rest else []
+            # Splits the request until the missing resources are isolated
+            # if the error does not name them.
+            if 1 == len(ids):
+                return []
+            half = len(ids) / 2
+            return self._describe(ids[:half]) + self._describe(ids[half:])
+
+    def _interval(self, targets, delay):
+        etas = [t.eta for t in targets if t.eta is not None]
+        if etas:
+            delay = min(etas) / Defaults.CHECKS
+        return max(Defaults.MIN_INTERVAL, min(Defaults.MAX_INTERVAL, delay))
+
+    def wait(self, targets, wait=True):
+        """Reports the status of the targets until all of them reach a
+        final state, or only once unless waiting. Resources that disappear
+        while waiting are considered deleted.
+        """
+        pending = list(targets)
+        delay = Defaults.MIN_INTERVAL
+        while True:
+            found = dict((x.id, x) for chunk in resource_selection.chunks(
+                [t.id for t in pending], Defaults.BATCH_SIZE)
+                    for x in self._describe(chunk))
+            missing = [t.id for t in pending
+                if t.state is None and t.id not in found]
+            if missing:
+                raise Error('could not find {0}'.format(', '.join(
+                    '\'{0}\''.format(id) for id in missing)))
+
+            now = time.time()
+            changed = list()
+            for t in pending:
+                x = found.get(t.id)
+                if x is None:
+                    state, progress = 'deleted', None
+                else:
+                    state, progress = self.get_state(x), self.get_progress(x)
+                if t.update(now, state, progress):
+                    changed.append(t)
+            self.reporter.report(targets, changed)
+
+            self.failures += sum(1 for t in changed
+                if t.state in self.failed)
+            pending = [t for t in pending if t.state in self.transitional]
+            if not wait or not pending:
+                return
+
+            # Checks again soon after a change, and backs off otherwise.
+            delay = Defaults.MIN_INTERVAL if changed else \
+                min(Defaults.MAX_INTERVAL, delay * Defaults.BACKOFF)
+            time.sleep(self._interval(pending, delay))
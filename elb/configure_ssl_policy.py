@@ -5,18 +5,35 @@
 
 """Configures AWS Elastic Load Balancer (ELB) SSL settings.
 
-A tool to configure SSL settings for AWS load balancers. It creates a new
+A tool to configure SSL settings for AWS load balancers. It creates an
 SSL policy with the correct TLS versions and ciphers enabled and applies
 it to the default HTTPS listener (port 443) on the load balancer.
 
+The policy is named after a hash of its attributes, so that an identical
+policy created before is reused and load balancers whose listener already
+uses it are skipped. The rest are updated concurrently across regions
+under a shared rate limit, which makes running it again a no-op.
+
+In audit mode nothing is changed. Instead, the SSL negotiation policies of
+all HTTPS and SSL listeners are compared with the desired attributes, and
+any drift is reported.
+
 Usage:
     ./configure_ssl_policy.py [options]
 """
 
 import boto.ec2.elb
+import boto.exception
+import collections
+import hashlib
+import json
 import optparse
+import re
 import sys
-import time
+
+from multiprocessing.pool import ThreadPool
+
+import load_balancers
 
 
 class Error(Exception):
@@ -27,74 +44,266 @@ class Defaults(object):
     """Default settings.
     """
     PORT = 443
+    THREADS = 16
+    RATE = 10
+
+
+POLICY_ATTRIBUTES = {
+    'Protocol-SSLv2': False,
+    'Protocol-SSLv3': False,
+    'Protocol-TLSv1': True,
+    'Protocol-TLSv1.1': True,
+    'Protocol-TLSv1.2': True,
+    'Server-Defined-Cipher-Order': True,
+    'ECDHE-ECDSA-AES128-GCM-SHA256': True,
+    'ECDHE-RSA-AES128-GCM-SHA256': True,
+    'ECDHE-ECDSA-AES128-SHA256': True,
+    'ECDHE-RSA-AES128-SHA256': True,
+    'ECDHE-ECDSA-AES128-SHA': True,
+    'ECDHE-RSA-AES128-SHA': True,
+    'ECDHE-ECDSA-AES256-GCM-SHA384': False,
+    'ECDHE-RSA-AES256-GCM-SHA384': False,
+    'ECDHE-ECDSA-AES256-SHA384': False,
+    'ECDHE-RSA-AES256-SHA384': False,
+    'ECDHE-RSA-AES256-SHA': True,
+    'ECDHE-ECDSA-AES256-SHA': True,
+    'AES128-GCM-SHA256': False,
+    'AES128-SHA256': True,
+    'AES128-SHA': True,
+    'AES256-GCM-SHA384': False,
+    'AES256-SHA256': True,
+    'AES256-SHA': True,
+    'DHE-RSA-AES128-SHA': False,
+    'DHE-DSS-AES128-SHA': False,
+    'CAMELLIA128-SHA': False,
+    'EDH-RSA-DES-CBC3-SHA': False,
+    'DES-CBC3-SHA': False,
+    'ECDHE-RSA-RC4-SHA': False,
+    'RC4-SHA': False
+}
+
+
+def get_policy_name(attributes):
+    """Returns a name that is unique to the set of policy attributes.
+    """
+    digest = hashlib.sha1(json.dumps(sorted(attributes.iteritems())))
+    return 'SSLNegotiationPolicy-{0}'.format(digest.hexdigest()[:8])
+
+
+def _get_listener(lb, port):
+    for l in lb.listeners:
+        if port == l.load_balancer_port:
+            return l
+    raise Error('no listener on port {0}'.format(port))
+
+
+def configure(region, lb, port, attributes, limiter):
+    """Applies the policy to the listener on the specified port unless it
+    already uses it, and returns what has been done.
+    """
+    name = get_policy_name(attributes)
+    if name in _get_listener(lb, port).policy_names:
+        return 'unchanged'
+    c = load_balancers.connect(region)
+    if name not in [p.policy_name for p in lb.policies.other_policies]:
+        limiter.acquire()
+        load_balancers.call(c.create_lb_policy, lb.name, name,
+            'SSLNegotiationPolicyType', attributes)
+    limiter.acquire()
+    load_balancers.call(c.set_lb_policies_of_listener, lb.name, port,
+        [name])
+    return 'updated'
+
+
+def configure_all(pool, lbs, port, attributes, rate):
+    """Configures the load balancers concurrently, reporting progress as
+    each one is done, and returns the number of failures.
+    """
+    limiter = load_balancers.RateLimiter(rate)
+    def _configure(x):
+        region, lb = x
+        try:
+            return region, lb.name, configure(region, lb, port, attributes,
+                limiter), None
+        except Exception, err:
+            return region, lb.name, None, load_balancers.get_message(err)
+
+    counts = dict(updated=0, unchanged=0, failed=0)
+    for n, (region, name, result, err) in enumerate(
+            pool.imap_unordered(_configure, lbs), 1):
+        if err is not None:
+            sys.stderr.write('[ERROR] {0}: {1}: {2}\n'.format(region, name,
+                err))
+            result = 'failed'
+        else:
+            print '[{0}/{1}] {2}: {3}: {4}'.format(n, len(lbs), region, name,
+                result)
+        counts[result] += 1
+    print 'Load balancers: {0}, updated: {1}, unchanged: {2}, ' \
+        'failed: {3}'.format(len(lbs), counts['updated'],
+            counts['unchanged'], counts['failed'])
+    return counts['failed']
+
+
+def load_attributes(path):
+    """Loads policy attributes from a JSON file that maps their names to
+    whether they are enabled.
+    """
+    try:
+        with open(path) as f:
+            attributes = json.load(f)
+    except IOError, err:
+        raise Error('could not read \'{0}\': {1}'.format(path, err.strerror))
+    except ValueError, err:
+        raise Error('could not parse \'{0}\': {1}'.format(path, err))
+    if (not isinstance(attributes, dict) or
+        not all(isinstance(v, bool) for v in attributes.itervalues())):
+        raise Error('\'{0}\' does not map attributes to true or false'
+            .format(path))
+    return attributes
+
+
+# Predefined policies and the ones created by this tool are the same on
+# every load balancer that has them.
+_SHARED_POLICY = re.compile(
+    r'^(ELBSecurityPolicy-.+|SSLNegotiationPolicy-[0-9a-f]{8})$')
+
+
+def _get_policy_key(region, lb, name):
+    """Returns the key of a policy of a load balancer as used by
+    describe_policies(). Policies belong to a single load balancer, unless
+    their names guarantee that they are identical.
+    """
+    return region, None if _SHARED_POLICY.match(name) else lb, name
+
+
+def describe_policies(pool, lbs):
+    """Returns a dictionary of policy keys to attributes of the SSL
+    negotiation policies used by listeners. Shared policies are described
+    only once, since many load balancers use the same ones.
+    """
+    keys = collections.OrderedDict()
+    for region, lb in lbs:
+        for l in lb.listeners:
+            for name in l.policy_names:
+                keys.setdefault(_get_policy_key(region, lb.name, name),
+                    lb.name)
+    def _describe(x):
+        key, lb = x
+        region, _, name = key
+        p = load_balancers.describe_policies(region, lb, [name])[0]
+        if 'SSLNegotiationPolicyType' != p.policy_type_name:
+            return key, None
+        return key, dict((a.name, a.value) for a in p.attributes)
+    return dict(pool.map(_describe, keys.items()))
+
+
+def get_drift(attributes, desired):
+    """Returns a sorted list of (attribute, actual, desired) tuples of the
+    attributes that differ from the desired ones.
+    """
+    drift = list()
+    for k, v in sorted(desired.iteritems()):
+        actual = attributes.get(k)
+        if actual is None or (actual.lower() == 'true') != v:
+            drift.append((k, actual, v))
+    return drift
+
+
+def audit(pool, lbs, desired):
+    """Reports every HTTPS or SSL listener whose SSL negotiation policy
+    differs from the desired attributes, and returns the number of them.
+    """
+    policies = describe_policies(pool, lbs)
+    listeners = drifted = 0
+    for region, lb in lbs:
+        for l in lb.listeners:
+            if l.protocol.upper() not in ('HTTPS', 'SSL'):
+                continue
+            listeners += 1
+            ssl = [n for n in l.policy_names if policies.get(
+                _get_policy_key(region, lb.name, n)) is not None]
+            if not ssl:
+                print '{0}: {1}:{2}: no SSL negotiation policy'.format(region,
+                    lb.name, l.load_balancer_port)
+                drifted += 1
+                continue
+            drift = get_drift(policies[_get_policy_key(region, lb.name,
+                ssl[0])], desired)
+            if drift:
+                print '{0}: {1}:{2}: {3}: {4}'.format(region, lb.name,
+                    l.load_balancer_port, ssl[0], ', '.join(
+                        '{0} is {1} (expected {2})'.format(k,
+                            'missing' if a is None else a.lower(),
+                            str(v).lower()) for k, a, v in drift))
+                drifted += 1
+    print 'Load balancers: {0}, listeners: {1}, drifted: {2}'.format(
+        len(lbs), listeners, drifted)
+    return drifted
 
 
 def main():
     parser = optparse.OptionParser('Usage: %prog [options]')
     parser.add_option('-l', '--load-balancer', dest='lbs', action='append',
         help='A list of AWS load balancers to configure the policy on. '
-             'This option is required.')
-    parser.add_option('-p', '--port', dest='port', default=Defaults.PORT,
-        help='The port number of an HTTPS listener. This option is not '
-             'required and is set to 443 by default.')
+             'This option is required unless --all is specified.')
+    parser.add_option('-a', '--all', dest='all', action='store_true',
+        help='Configure the policy on all load balancers that have a '
+             'listener on the port.')
+    parser.add_option('--audit', dest='audit', action='store_true',
+        help='Only report HTTPS and SSL listeners of the specified load '
+             'balancers (or all of them, if none) whose policy differs from '
+             'the desired attributes, without changing anything.')
+    parser.add_option('--attributes', dest='attributes', metavar='FILE',
+        help='A JSON file that maps policy attributes (e.g., Protocol-SSLv3) '
+             'to whether they should be enabled. The recommended settings '
+             'are used by default.')
+    parser.add_option('-p', '--port', dest='port', type='int',
+        default=Defaults.PORT, help='The port number of an HTTPS listener. '
+        'This option is not required and is set to 443 by default.')
+    parser.add_option('-r', '--region', dest='regions', action='append',
+        help='The name of the region to look for load balancers in. All '
+             'regions are searched by default.')
+    parser.add_option('-t', '--threads', dest='threads', type='int',
+        default=Defaults.THREADS, help='The number of concurrent requests. '
+        'This is set to 16 by default.')
+    parser.add_option('--rate', dest='rate', type='float',
+        default=Defaults.RATE, help='The maximum number of changes per '
+        'second. This is set to 10 by default, 0 disables the limit.')
     (opts, args) = parser.parse_args()
 
-    if 0 != len(args) or opts.lbs is None:
+    if (0 != len(args) or
+        (not opts.audit and (opts.lbs is None) == (opts.all is None)) or
+        1 > opts.threads or
+        0 > opts.rate):
         parser.print_help()
         return 1
 
     try:
-        elb = boto.connect_elb()
-
-        policy_attributes = {
-            'Protocol-SSLv2': False,
-            'Protocol-SSLv3': True,
-            'Protocol-TLSv1': True,
-            'Protocol-TLSv1.1': True,
-            'Protocol-TLSv1.2': True,
-            'Server-Defined-Cipher-Order': True,
-            'ECDHE-ECDSA-AES128-GCM-SHA256': True,
-            'ECDHE-RSA-AES128-GCM-SHA256': True,
-            'ECDHE-ECDSA-AES128-SHA256': True,
-            'ECDHE-RSA-AES128-SHA256': True,
-            'ECDHE-ECDSA-AES128-SHA': True,
-            'ECDHE-RSA-AES128-SHA': True,
-            'ECDHE-ECDSA-AES256-GCM-SHA384': False,
-            'ECDHE-RSA-AES256-GCM-SHA384': False,
-            'ECDHE-ECDSA-AES256-SHA384': False,
-            'ECDHE-RSA-AES256-SHA384': False,
-            'ECDHE-RSA-AES256-SHA': True,
-            'ECDHE-ECDSA-AES256-SHA': True,
-            'AES128-GCM-SHA256': False,
-            'AES128-SHA256': True,
-            'AES128-SHA': True,
-            'AES256-GCM-SHA384': False,
-            'AES256-SHA256': True,
-            'AES256-SHA': True,
-            'DHE-RSA-AES128-SHA': False,
-            'DHE-DSS-AES128-SHA': False,
-            'CAMELLIA128-SHA': False,
-            'EDH-RSA-DES-CBC3-SHA': False,
-            'DES-CBC3-SHA': False,
-            'ECDHE-RSA-RC4-SHA': True,
-            'RC4-SHA': True
-        }
-
-        for lb in opts.lbs:
-            policy = elb.create_lb_policy(lb,
-                'SSLNegotiationPolicy-{0}-{1}' \
-                    .format(lb, time.strftime('%Y%m%d%H%M%S', time.gmtime())),
-                'SSLNegotiationPolicyType',
-                policy_attributes)
-
-            elb.set_lb_policies_of_listener(lb, opts.port, [policy])
-    except Error, err:
+        attributes = POLICY_ATTRIBUTES
+        if opts.attributes is not None:
+            attributes = load_attributes(opts.attributes)
+
+        pool = ThreadPool(opts.threads)
+        lbs = load_balancers.get_load_balancers(pool,
+            load_balancers.get_regions(opts.regions), opts.lbs)
+        if opts.audit:
+            return 1 if audit(pool, lbs, attributes) else 0
+        if opts.all:
+            lbs = [(r, lb) for r, lb in lbs
+                if any(opts.port == l.load_balancer_port
+                    for l in lb.listeners)]
+        if configure_all(pool, lbs, opts.port, attributes, opts.rate):
+            return 1
+    except (Error, load_balancers.Error), err:
         sys.stderr.write('[ERROR] {0}\n'.format(err))
         return 1
+    except boto.exception.BotoServerError, err:
+        sys.stderr.write('[ERROR] {0}\n'.format(err.error_message or err))
+        return 1
 
     return 0
 
 
 if __name__ == '__main__':
     sys.exit(main())
-
@@ -8,44 +8,164 @@
 A simple script to deregister all currently registered EC2 instances from
 the load balancer.
 
+Any number of load balancers are processed concurrently. Instances are
+deregistered in chunks, and the script waits until all of them are gone
+from their load balancers, i.e., until connection draining is over, with
+a single health request per load balancer per check.
+
 Usage:
     ./deregister_all_instances.py [options]
 """
 
 import boto.ec2.elb
+import boto.exception
 import optparse
 import sys
+import time
+
+from multiprocessing.pool import ThreadPool
+
+import load_balancers
 
 
 class Error(Exception):
     pass
 
 
+class Defaults(object):
+    """Default settings.
+    """
+    THREADS = 16
+    RATE = 10
+    CHUNK_SIZE = 20
+    MIN_DELAY = 2
+    MAX_DELAY = 15
+
+
+def deregister(region, lb, ids, chunk_size, limiter):
+    """Deregisters instances from a load balancer in chunks.
+    """
+    c = load_balancers.connect(region)
+    for i in xrange(0, len(ids), chunk_size):
+        limiter.acquire()
+        load_balancers.call(c.deregister_instances, lb,
+            ids[i:i + chunk_size])
+
+
+def get_registered(region, lb):
+    """Returns a dictionary of IDs of the instances that are registered
+    with a load balancer (including the ones that are still draining) to
+    their health.
+    """
+    c = load_balancers.connect(region)
+    return dict((h.instance_id, h)
+        for h in load_balancers.call(c.describe_instance_health, lb))
+
+
+def wait_for_drain(pool, pending, timeout=None):
+    """Waits until the instances are gone from their load balancers. The
+    argument maps (region, load balancer) tuples to sets of instance IDs,
+    and is emptied as they drain. Raises an error if they are not gone
+    within the timeout, if any.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    delay = Defaults.MIN_DELAY
+    left = None
+    while pending:
+        time.sleep(delay)
+        keys = sorted(pending)
+        for key, registered in zip(keys, pool.map(
+                lambda k: get_registered(*k), keys)):
+            pending[key] &= set(registered)
+            if not pending[key]:
+                del pending[key]
+                sys.stdout.write('{0}: {1}: drained\n'.format(*key))
+        n = sum(len(ids) for ids in pending.itervalues())
+        if n != left:
+            if 0 != n:
+                print '{0} instance(s) draining from {1} load balancer(s)' \
+                    .format(n, len(pending))
+            delay = Defaults.MIN_DELAY
+        else:
+            delay = min(delay * 2, Defaults.MAX_DELAY)
+        left = n
+        if (pending and deadline is not None and
+            time.time() + delay > deadline):
+            raise Error('{0} did not drain within {1} second(s)'.format(
+                ', '.join('\'{0}\''.format(id) for key in sorted(pending)
+                    for id in sorted(pending[key])), timeout))
+
+
+def deregister_all(pool, lbs, chunk_size, rate, wait=True):
+    """Deregisters all instances from the load balancers concurrently and
+    waits for them to drain. Returns the number of failures.
+    """
+    limiter = load_balancers.RateLimiter(rate)
+    def _deregister(x):
+        region, lb = x
+        ids = [i.id for i in lb.instances]
+        try:
+            deregister(region, lb.name, ids, chunk_size, limiter)
+        except Exception, err:
+            sys.stderr.write('[ERROR] {0}: {1}: {2}\n'.format(region,
+                lb.name, load_balancers.get_message(err)))
+            return None
+        # Written at once, since print is not atomic across threads.
+        sys.stdout.write('{0}: {1}: deregistered {2} instance(s)\n'.format(
+            region, lb.name, len(ids)))
+        return (region, lb.name), set(ids)
+
+    results = pool.map(_deregister, lbs)
+    if wait:
+        wait_for_drain(pool, dict(x for x in results if x and x[1]))
+    return results.count(None)
+
+
 def main():
     parser = optparse.OptionParser('Usage: %prog [options]')
-    parser.add_option('-l', '--load-balancer', dest='lb',
-        help='The name of the load balancer to deregister instances from.')
+    parser.add_option('-l', '--load-balancer', dest='lbs', action='append',
+        help='The name of the load balancer to deregister instances from. '
+             'Can be specified multiple times.')
+    parser.add_option('-r', '--region', dest='regions', action='append',
+        help='The name of the region to look for load balancers in. All '
+             'regions are searched by default.')
+    parser.add_option('-c', '--chunk-size', dest='chunk_size', type='int',
+        default=Defaults.CHUNK_SIZE, help='The number of instances to '
+        'deregister per request. This is set to 20 by default.')
+    parser.add_option('-t', '--threads', dest='threads', type='int',
+        default=Defaults.THREADS, help='The number of concurrent requests. '
+        'This is set to 16 by default.')
+    parser.add_option('--rate', dest='rate', type='float',
+        default=Defaults.RATE, help='The maximum number of requests to '
+        'deregister instances per second. This is set to 10 by default, 0 '
+        'disables the limit.')
+    parser.add_option('--no-wait', dest='wait', action='store_false',
+        default=True, help='Do not wait for connections to drain.')
     (opts, args) = parser.parse_args()
 
-    if 0 != len(args):
+    if (0 != len(args) or
+        opts.lbs is None or
+        1 > opts.chunk_size or
+        1 > opts.threads or
+        0 > opts.rate):
         parser.print_help()
         return 1
 
     try:
-        elb = boto.connect_elb()
-
-        lb = elb.get_all_load_balancers([opts.lb])
-        if lb is None:
-            raise Error('could not find \'{0}\''.format(opts.lb))
-
-        elb.deregister_instances(opts.lb, [i.id for i in lb.instances])
-    except Error, err:
+        pool = ThreadPool(opts.threads)
+        lbs = load_balancers.get_load_balancers(pool,
+            load_balancers.get_regions(opts.regions), set(opts.lbs))
+        if deregister_all(pool, lbs, opts.chunk_size, opts.rate, opts.wait):
+            return 1
+    except (Error, load_balancers.Error), err:
         sys.stderr.write('[ERROR] {0}\n'.format(err))
         return 1
+    except boto.exception.BotoServerError, err:
+        sys.stderr.write('[ERROR] {0}\n'.format(err.error_message or err))
+        return 1
 
     return 0
 
 
 if __name__ == '__main__':
     sys.exit(main())
-
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# Copyright (c) 2014 Eugene Zhuk.
+# Use of this source code is governed by the MIT license that can be found
+# in the LICENSE file.
+
+"""Finds AWS Elastic Load Balancers (ELB) across regions.
+
+Load balancers are listed page by page in all regions (or the specified
+ones) in parallel, and their policies can be described along with their
+attributes. Requests are retried with exponential backoff while throttled,
+and a token bucket caps the rate of changes shared by all threads.
+"""
+
+import boto.ec2.elb
+import boto.exception
+import random
+import threading
+import time
+
+from boto.resultset import ResultSet
+
+
+class Error(Exception):
+    pass
+
+
+class Defaults(object):
+    """Default settings.
+    """
+    THREADS = 16
+    RATE = 10
+    RETRIES = 8
+    BACKOFF = 0.5
+
+
+_local = threading.local()
+
+
+def connect(region):
+    """Returns a connection to the specified region that belongs to the
+    calling thread, since connections can not be shared between threads.
+    """
+    if not hasattr(_local, 'connections'):
+        _local.connections = dict()
+    if region not in _local.connections:
+        _local.connections[region] = boto.ec2.elb.connect_to_region(region)
+    return _local.connections[region]
+
+
+def get_regions(regions):
+    if regions is not None:
+        return [r.name for r in boto.ec2.elb.regions() if r.name in regions]
+    else:
+        return [r.name for r in boto.ec2.elb.regions()
+            if not r.name.startswith(('us-gov-', 'cn-'))]
+
+
+def call(fn, *args, **kwargs):
+    """Calls an API function, backing off exponentially while requests
+    are throttled.
+    """
+    delay = Defaults.BACKOFF
+    for i in xrange(Defaults.RETRIES):
+        try:
+            return fn(*args, **kwargs)
+        except boto.exception.BotoServerError, err:
+            if 'Throttling' != err.error_code or Defaults.RETRIES - 1 == i:
+                raise
+        time.sleep(random.uniform(0, delay))
+        delay *= 2
+
+
+def get_message(err):
+    return getattr(err, 'error_message', None) or err
+
+
+class RateLimiter(object):
+    """A thread-safe token bucket that caps the number of requests per
+    second shared by all threads. A rate of zero disables the limit.
+    """
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if 0 >= self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.rate,
+                    self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if 1 <= self.tokens:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+def _get_all(region):
+    c = connect(region)
+    lbs = list()
+    marker = None
+    while True:
+        rs = call(c.get_all_load_balancers, marker=marker)
+        lbs.extend(rs)
+        marker = getattr(rs, 'next_marker', None)
+        if not marker:
+            return lbs
+
+
+def get_load_balancers(pool, regions, names=None):
+    """Returns a sorted list of (region, load balancer) tuples of the load
+    balancers with the specified names (or all of them, if none) found in
+    the specified regions.
+    """
+    lbs = sorted(((r, lb) for r, rs in zip(regions, pool.map(_get_all,
+        regions)) for lb in rs if names is None or lb.name in names),
+        key=lambda x: (x[0], x[1].name))
+    if names is not None:
+        missing = set(names) - set(lb.name for _, lb in lbs)
+        if missing:
+            raise Error('could not find {0}'.format(', '.join(
+                '\'{0}\''.format(n) for n in sorted(missing))))
+    return lbs
+
+
+class PolicyAttribute(object):
+    def __init__(self, connection=None):
+        self.name = None
+        self.value = None
+
+    def startElement(self, name, attrs, connection):
+        return None
+
+    def endElement(self, name, value, connection):
+        if 'AttributeName' == name:
+            self.name = value
+        elif 'AttributeValue' == name:
+            self.value = value
+
+
+class PolicyDescription(object):
+    """A load balancer policy as returned by DescribeLoadBalancerPolicies.
+    """
+    def __init__(self, connection=None):
+        self.policy_name = None
+        self.policy_type_name = None
+        self.attributes = list()
+
+    def startElement(self, name, attrs, connection):
+        if 'PolicyAttributeDescriptions' == name:
+            self.attributes = ResultSet([('member', PolicyAttribute)])
+            return self.attributes
+        return None
+
+    def endElement(self, name, value, connection):
+        if 'PolicyName' == name:
+            self.policy_name = value
+        elif 'PolicyTypeName' == name:
+            self.policy_type_name = value
+
+
+def describe_policies(region, lb, names):
+    """Returns descriptions of the specified policies of a load balancer.
+    """
+    c = connect(region)
+    params = {'LoadBalancerName': lb}
+    c.build_list_params(params, names, 'PolicyNames.member.%d')
+    return call(c.get_list, 'DescribeLoadBalancerPolicies', params,
+        [('member', PolicyDescription)])
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# Copyright (c) 2014 Eugene Zhuk.
+# Use of this source code is governed by the MIT license that can be found
+# in the LICENSE file.
+
+"""Deploys to instances behind an AWS Elastic Load Balancer (ELB) in waves.
+
+Instances are cycled out of the load balancer in waves of a percentage of
+them. Every wave is deregistered and drained, a hook command (e.g., one
+that deploys a new release) is run for its instances, and they are
+registered again and have to pass health checks before the deploy moves
+on. The next wave is drained while the current one is being verified, as
+long as the share of instances that are out of service stays within the
+limit.
+
+Usage:
+    ./rolling_deploy.py <options>
+"""
+
+import boto.ec2.elb
+import boto.exception
+import math
+import optparse
+import subprocess
+import sys
+import time
+
+from multiprocessing.pool import ThreadPool
+
+import deregister_all_instances as dai
+import load_balancers
+
+
+class Error(Exception):
+    pass
+
+
+class Defaults(object):
+    """Default settings.
+    """
+    WAVE = 25
+    IN_SERVICE = 75
+    CHUNK_SIZE = 20
+    TIMEOUT = 600
+
+
+def get_waves(ids, healthy, wave, in_service):
+    """Splits instances into waves of the specified percentage of them, so
+    that at least the specified percentage of them stays in service, and
+    returns them along with the number of instances that can be out of
+    service at once. Only the healthy instances count towards the ones in
+    service.
+    """
+    n = len(ids)
+    budget = healthy - int(math.ceil(n * in_service / 100.0))
+    if 1 > budget:
+        raise Error('can not keep {0}% of {1} instance(s) in service with '
+            '{2} of them in service'.format(in_service, n, healthy))
+    size = max(1, min(budget, int(math.ceil(n * wave / 100.0))))
+    return [ids[i:i + size] for i in xrange(0, n, size)], budget
+
+
+def register(region, lb, ids, chunk_size):
+    c = load_balancers.connect(region)
+    for i in xrange(0, len(ids), chunk_size):
+        load_balancers.call(c.register_instances, lb, ids[i:i + chunk_size])
+
+
+def get_healthy(region, lb):
+    """Returns the IDs of the instances that are in service.
+    """
+    return [id for id, h in dai.get_registered(region, lb).iteritems()
+        if 'InService' == h.state]
+
+
+def drain(pool, region, lb, ids, chunk_size, timeout):
+    """Deregisters instances and waits until they are gone from the load
+    balancer, i.e., until connection draining is over, and raises an error
+    if they are not within the timeout.
+    """
+    dai.deregister(region, lb, ids, chunk_size,
+        load_balancers.RateLimiter(0))
+    dai.wait_for_drain(pool, {(region, lb): set(ids)}, timeout)
+
+
+def wait_until_healthy(region, lb, ids, timeout):
+    """Waits until all instances are in service, and raises an error if
+    they are not within the timeout.
+    """
+    c = load_balancers.connect(region)
+    deadline = time.time() + timeout
+    delay = dai.Defaults.MIN_DELAY
+    while True:
+        health = load_balancers.call(c.describe_instance_health, lb, ids)
+        unhealthy = sorted(h.instance_id for h in health
+            if 'InService' != h.state)
+        if not unhealthy:
+            return
+        if time.time() + delay > deadline:
+            raise Error('{0} did not pass health checks'.format(', '.join(
+                '\'{0}\''.format(id) for id in unhealthy)))
+        time.sleep(delay)
+        delay = min(delay * 2, dai.Defaults.MAX_DELAY)
+
+
+def _report(k, waves, message):
+    # Written at once, since print is not atomic across threads.
+    sys.stdout.write('Wave {0}/{1}: {2}\n'.format(k + 1, len(waves),
+        message))
+    sys.stdout.flush()
+
+
+def deploy(region, lb, waves, budget, hook, chunk_size, timeout):
+    """Runs the hook for every wave of instances while they are out of the
+    load balancer. The next wave is drained in the background while the
+    current one is being verified, if both fit into the budget. If a wave
+    fails, the next one is registered again and the deploy stops.
+    """
+    pool = ThreadPool(1)
+    # Drains are waited for on a pool of their own, since they already run
+    # on the one above.
+    checks = ThreadPool(1)
+    def _drain(k):
+        drain(checks, region, lb, waves[k], chunk_size, timeout)
+        _report(k, waves, 'drained {0}'.format(', '.join(waves[k])))
+
+    draining = pool.apply_async(_drain, (0,))
+    for k, wave in enumerate(waves):
+        try:
+            draining.get()
+        except dai.Error, err:
+            register(region, lb, wave, chunk_size)
+            raise Error('wave {0}: {1}, registered again'.format(k + 1, err))
+        draining = None
+        if hook is not None:
+            code = subprocess.call('{0} {1}'.format(hook, ' '.join(wave)),
+                shell=True)
+            if 0 != code:
+                raise Error('wave {0}: hook exited with {1}, {2} left out '
+                    'of service'.format(k + 1, code, ', '.join(wave)))
+            _report(k, waves, 'hook done')
+        register(region, lb, wave, chunk_size)
+
+        last = k + 1 == len(waves)
+        if not last and len(wave) + len(waves[k + 1]) <= budget:
+            draining = pool.apply_async(_drain, (k + 1,))
+        try:
+            wait_until_healthy(region, lb, wave, timeout)
+        except Error, err:
+            if draining is not None:
+                try:
+                    draining.get()
+                except dai.Error:
+                    pass
+                register(region, lb, waves[k + 1], chunk_size)
+            raise Error('wave {0}: {1}'.format(k + 1, err))
+        _report(k, waves, 'in service')
+        if not last and draining is None:
+            draining = pool.apply_async(_drain, (k + 1,))
+
+
+def main():
+    parser = optparse.OptionParser('Usage: %prog <options>')
+    parser.add_option('-l', '--load-balancer', dest='lb',
+        help='The name of the load balancer to deploy to the instances of.')
+    parser.add_option('-r', '--region', dest='regions', action='append',
+        help='The name of the region to look for the load balancer in. All '
+             'regions are searched by default.')
+    parser.add_option('-x', '--hook', dest='hook',
+        help='A shell command to run for every wave, with the IDs of its '
+             'instances as arguments. The deploy stops if it fails.')
+    parser.add_option('-w', '--wave', dest='wave', type='int',
+        default=Defaults.WAVE, help='The percentage of instances to take '
+        'out of service at once. This is set to 25 by default.')
+    parser.add_option('-m', '--min-in-service', dest='in_service',
+        type='int', default=Defaults.IN_SERVICE, help='The percentage of '
+        'instances that must stay in service. This is set to 75 by default.')
+    parser.add_option('-c', '--chunk-size', dest='chunk_size', type='int',
+        default=Defaults.CHUNK_SIZE, help='The number of instances to '
+        '(de)register per request. This is set to 20 by default.')
+    parser.add_option('--timeout', dest='timeout', type='int',
+        default=Defaults.TIMEOUT, help='The number of seconds to wait for a '
+        'wave to drain and then to pass health checks. This is set to 600 by '
+        'default.')
+    (opts, args) = parser.parse_args()
+
+    if (0 != len(args) or
+        opts.lb is None or
+        not 0 < opts.wave <= 100 or
+        not 0 <= opts.in_service < 100 or
+        1 > opts.chunk_size or
+        0 > opts.timeout):
+        parser.print_help()
+        return 1
+
+    try:
+        regions = load_balancers.get_regions(opts.regions)
+        lbs = load_balancers.get_load_balancers(
+            ThreadPool(load_balancers.Defaults.THREADS), regions, [opts.lb])
+        if 1 != len(lbs):
+            raise Error('\'{0}\' exists in more than one region'.format(
+                opts.lb))
+        region, lb = lbs[0]
+        ids = sorted(i.id for i in lb.instances)
+        if not ids:
+            raise Error('\'{0}\' has no instances'.format(opts.lb))
+
+        healthy = get_healthy(region, lb.name)
+        waves, budget = get_waves(ids, len(healthy), opts.wave,
+            opts.in_service)
+        print 'Deploying to {0} instance(s) in {1} wave(s)'.format(len(ids),
+            len(waves))
+        deploy(region, lb.name, waves, budget, opts.hook, opts.chunk_size,
+            opts.timeout)
+    except (Error, load_balancers.Error), err:
+        sys.stderr.write('[ERROR] {0}\n'.format(err))
+        return 1
+    except boto.exception.BotoServerError, err:
+        sys.stderr.write('[ERROR] {0}\n'.format(err.error_message or err))
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
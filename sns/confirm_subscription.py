@@ -14,25 +14,73 @@ Usage:
 """
 
 import BaseHTTPServer
+import base64
+import bisect
+import collections
+import hashlib
+import httplib
 import json
 import optparse
+import Queue
+import re
 import SimpleHTTPServer
-import SocketServer
+import socket
+import sqlite3
 import ssl
+import struct
 import sys
+import threading
+import time
 import urllib2
+import urlparse
 
 from xml.etree import ElementTree
 
+import notification_sinks
+
+try:
+    from cryptography import x509
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+except ImportError:
+    x509 = None
+
 
 class Error(Exception):
     pass
 
 
+class TemporaryError(Error):
+    """Raised when a message can not be handled for now, so that SNS should
+    deliver it again.
+    """
+    pass
+
+
 class Defaults(object):
     """Default settings.
     """
     PORT = 8080
+    THREADS = 16
+    QUEUE_SIZE = 256
+    BACKLOG = 128
+    KEEPALIVE_TIMEOUT = 1
+    CONFIRM_THREADS = 4
+    CONFIRM_QUEUE_SIZE = 1024
+    CONFIRM_RETRIES = 5
+    CONFIRM_TIMEOUT = 10
+    CERT_CACHE_SIZE = 16
+    CERT_CACHE_TTL = 3600
+    DEDUP_SIZE = 100000
+    DEDUP_TTL = 3600
+    SINK = 'stdout'
+    SINK_QUEUE_SIZE = 10000
+    SINK_RETRIES = 5
+    BATCH_SIZE = 100
+    FLUSH_INTERVAL = 1.0
+    FILE_SIZE = 64
 
 
 class MessageType(object):
@@ -42,10 +90,400 @@ class MessageType(object):
     NOTIFICATION = 'Notification'
 
 
-class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
-    """Use the ThreadingMixIn to handle requests in multiple threads.
+class CertificateCache(object):
+    """Caches public keys of SNS signing certificates by their URL. Entries
+    expire after the specified time and the least recently used ones get
+    evicted once the cache is full. Concurrent requests for a certificate
+    that is not cached yet wait for a single download.
     """
-    pass
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.pending = dict()
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        with self.lock:
+            entry = self.entries.pop(url, None)
+            if entry is not None and time.time() < entry[1]:
+                self.entries[url] = entry
+                return entry[0]
+            fetch = self.pending.get(url)
+            leader = fetch is None
+            if leader:
+                fetch = self.pending[url] = _Fetch()
+
+        if leader:
+            try:
+                fetch.key = self._load(url)
+            except Exception, err:
+                fetch.error = err
+            with self.lock:
+                del self.pending[url]
+                if fetch.error is None:
+                    self.entries[url] = (fetch.key, time.time() + self.ttl)
+                    while self.size < len(self.entries):
+                        self.entries.popitem(last=False)
+            fetch.event.set()
+        else:
+            fetch.event.wait()
+
+        if fetch.error is not None:
+            # Failed downloads are not cached, so they can be retried.
+            raise (TemporaryError if isinstance(fetch.error, IOError)
+                else Error)('could not load certificate \'{0}\': {1}'
+                    .format(url, fetch.error))
+        return fetch.key
+
+    def _load(self, url):
+        pem = urllib2.urlopen(url, timeout=Defaults.CONFIRM_TIMEOUT).read()
+        return x509.load_pem_x509_certificate(pem,
+            default_backend()).public_key()
+
+
+class _Fetch(object):
+    """Represents a certificate download in progress.
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.key = None
+        self.error = None
+
+
+class Verifier(object):
+    """Verifies signatures of SNS messages.
+    """
+    CERT_HOST = re.compile(r'^sns\.[a-z0-9-]+\.amazonaws\.com(\.cn)?$')
+
+    NOTIFICATION_KEYS = ['Message', 'MessageId', 'Subject', 'Timestamp',
+        'TopicArn', 'Type']
+    CONFIRMATION_KEYS = ['Message', 'MessageId', 'SubscribeURL', 'Timestamp',
+        'Token', 'TopicArn', 'Type']
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def verify(self, data):
+        """Raises an error unless the message has a valid signature.
+        """
+        version = data.get('SignatureVersion')
+        if '1' == version:
+            algorithm = hashes.SHA1()
+        elif '2' == version:
+            algorithm = hashes.SHA256()
+        else:
+            raise Error('unsupported signature version \'{0}\''
+                .format(version))
+
+        url = data.get('SigningCertURL', '')
+        u = urlparse.urlsplit(url)
+        if ('https' != u.scheme or
+            not self.CERT_HOST.match(u.hostname or '') or
+            not u.path.endswith('.pem')):
+            raise Error('untrusted certificate \'{0}\''.format(url))
+
+        key = self.cache.get(url)
+        try:
+            key.verify(base64.b64decode(data['Signature']),
+                self._string_to_sign(data),
+                padding.PKCS1v15(),
+                algorithm)
+        except (InvalidSignature, KeyError, TypeError):
+            raise Error('invalid signature')
+
+    def _string_to_sign(self, data):
+        keys = self.NOTIFICATION_KEYS \
+            if MessageType.NOTIFICATION == data.get('Type') \
+            else self.CONFIRMATION_KEYS
+        return ''.join(u'{0}\n{1}\n'.format(k, data[k])
+            for k in keys if k in data).encode('utf-8')
+
+
+def _message_key(message_id):
+    """Returns a compact 64-bit key for the specified message ID.
+    """
+    return struct.unpack('<q',
+        hashlib.sha1(message_id.encode('utf-8')).digest()[:8])[0]
+
+
+class MessageCache(object):
+    """Remembers message IDs seen within the specified time to drop repeated
+    deliveries. Hashed IDs are kept in insertion order in a ring along with a
+    dictionary of them to the time they were added for lookups, so memory is
+    bounded by the specified size.
+    """
+    def __init__(self, size, ttl, store=None):
+        self.size = size
+        self.ttl = ttl
+        self.store = store
+        self.ring = collections.deque()
+        self.seen = dict()
+        self.lock = threading.Lock()
+
+    def discard(self, message_id):
+        """Forgets the message so that its redelivery is not dropped.
+        """
+        key = _message_key(message_id)
+        with self.lock:
+            self.seen.pop(key, None)
+        if self.store is not None:
+            self.store.discard(key)
+
+    def add(self, message_id):
+        """Returns True if the message has not been seen before. The message
+        is not remembered if the store fails.
+        """
+        key = _message_key(message_id)
+        now = time.time()
+        with self.lock:
+            while self.ring and (self.ring[0][0] <= now - self.ttl or
+                    self.size <= len(self.ring)):
+                t, k = self.ring.popleft()
+                # Entries of forgotten or re-added IDs are left in the ring.
+                if self.seen.get(k) == t:
+                    del self.seen[k]
+            if key in self.seen:
+                return False
+            self.ring.append((now, key))
+            self.seen[key] = now
+        if self.store is None:
+            return True
+        try:
+            return self.store.add(key, now)
+        except Exception:
+            with self.lock:
+                if self.seen.get(key) == now:
+                    del self.seen[key]
+            raise
+
+
+class MessageStore(object):
+    """Keeps seen message IDs in an sqlite database so that multiple
+    endpoint processes can share them.
+    """
+    # The number of insertions between removals of expired IDs.
+    CLEANUP_INTERVAL = 1000
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.inserts = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self._connect().execute('CREATE TABLE IF NOT EXISTS messages '
+            '(key INTEGER PRIMARY KEY, time REAL NOT NULL)')
+
+    def add(self, key, now):
+        c = self._connect()
+        with c:
+            c.execute('DELETE FROM messages WHERE key = ? AND time <= ?',
+                (key, now - self.ttl))
+            added = 1 == c.execute('INSERT OR IGNORE INTO messages '
+                'VALUES (?, ?)', (key, now)).rowcount
+        with self.lock:
+            self.inserts += 1
+            cleanup = 0 == self.inserts % self.CLEANUP_INTERVAL
+        if cleanup:
+            with c:
+                c.execute('DELETE FROM messages WHERE time <= ?',
+                    (now - self.ttl,))
+        return added
+
+    def discard(self, key):
+        c = self._connect()
+        with c:
+            c.execute('DELETE FROM messages WHERE key = ?', (key,))
+
+    def _connect(self):
+        # Connections can not be shared between threads.
+        c = getattr(self.local, 'connection', None)
+        if c is None:
+            c = self.local.connection = sqlite3.connect(self.path, timeout=30)
+        return c
+
+
+class Metrics(object):
+    """Collects request metrics exposed in the Prometheus text format.
+    """
+    # Upper bounds of handler latency histogram buckets in seconds.
+    BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+        0.5, 1.0, 2.5]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = collections.defaultdict(int)
+        self.latency = collections.defaultdict(
+            lambda: [0] * (len(self.BUCKETS) + 1))
+        self.latency_sum = collections.defaultdict(float)
+        self.in_flight = 0
+        self.rejected = 0
+
+    def begin(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def end(self, message_type, status, elapsed):
+        t = self._type(message_type)
+        i = bisect.bisect_left(self.BUCKETS, elapsed)
+        with self.lock:
+            self.in_flight -= 1
+            self.requests[(t, status)] += 1
+            self.latency[t][i] += 1
+            self.latency_sum[t] += elapsed
+
+    def reject(self):
+        with self.lock:
+            self.rejected += 1
+
+    def render(self, depths):
+        with self.lock:
+            lines = ['# TYPE sns_requests_total counter']
+            for (t, status), n in sorted(self.requests.items()):
+                lines.append('sns_requests_total{{type="{0}",status="{1}"}} '
+                    '{2}'.format(t, status, n))
+            lines.append('# TYPE sns_request_seconds histogram')
+            for t, counts in sorted(self.latency.items()):
+                total = 0
+                for bound, n in zip(self.BUCKETS + ['+Inf'], counts):
+                    total += n
+                    lines.append('sns_request_seconds_bucket'
+                        '{{type="{0}",le="{1}"}} {2}'.format(t, bound, total))
+                lines.append('sns_request_seconds_sum{{type="{0}"}} {1}'
+                    .format(t, self.latency_sum[t]))
+                lines.append('sns_request_seconds_count{{type="{0}"}} {1}'
+                    .format(t, total))
+            lines.append('# TYPE sns_connections_rejected_total counter')
+            lines.append('sns_connections_rejected_total {0}'
+                .format(self.rejected))
+            lines.append('# TYPE sns_requests_in_flight gauge')
+            lines.append('sns_requests_in_flight {0}'.format(self.in_flight))
+        lines.append('# TYPE sns_queue_depth gauge')
+        for name, depth in sorted(depths.items()):
+            lines.append('sns_queue_depth{{queue="{0}"}} {1}'
+                .format(name, depth))
+        lines.append('# TYPE sns_threads gauge')
+        lines.append('sns_threads {0}'.format(threading.active_count()))
+        return '\n'.join(lines) + '\n'
+
+    def _type(self, message_type):
+        # Keeps the number of distinct labels bounded.
+        if message_type in (MessageType.CONFIRMATION,
+                MessageType.NOTIFICATION):
+            return message_type
+        return 'Unsupported'
+
+
+class Server(BaseHTTPServer.HTTPServer):
+    """Handles connections using a fixed pool of worker threads. Accepted
+    connections wait in a bounded queue and get rejected once it is full,
+    so bursts can not exhaust threads.
+    """
+    def __init__(self, address, handler, threads, queue_size, backlog):
+        # The listen backlog is applied when the server is activated.
+        self.request_queue_size = backlog
+        BaseHTTPServer.HTTPServer.__init__(self, address, handler)
+        self.requests = Queue.Queue(queue_size)
+        self.metrics = Metrics()
+        for _ in xrange(threads):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+
+    def process_request(self, request, client_address):
+        try:
+            self.requests.put_nowait((request, client_address))
+        except Queue.Full:
+            self.metrics.reject()
+            self._reject(request)
+
+    def get_queue_depths(self):
+        return {
+            'connections': self.requests.qsize(),
+            'confirmations': self.confirmer.queue.qsize(),
+            'notifications': self.pipeline.queue.qsize()
+        }
+
+    def _work(self):
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def _reject(self, request):
+        try:
+            request.sendall('HTTP/1.1 503 Service Unavailable\r\n'
+                'Content-Length: 0\r\n'
+                'Connection: close\r\n\r\n')
+        except Exception:
+            pass
+        self.shutdown_request(request)
+
+
+class Confirmer(object):
+    """Confirms subscriptions in the background using a small pool of
+    threads, so that request handlers do not have to wait for AWS. Every
+    thread keeps its connections open and reuses them across requests.
+    """
+    def __init__(self, threads, queue_size, retries):
+        self.queue = Queue.Queue(queue_size)
+        self.retries = retries
+        for _ in xrange(threads):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+
+    def submit(self, url):
+        """Schedules the specified subscribe URL to be visited. Raises
+        Queue.Full if there is no room.
+        """
+        self.queue.put_nowait(url)
+
+    def _work(self):
+        connections = dict()
+        while True:
+            url = self.queue.get()
+            try:
+                xml = ElementTree.XML(self._fetch(connections, url))
+                arn = xml.find('ConfirmSubscriptionResult/SubscriptionArn')
+                print arn.text
+            except Exception, err:
+                sys.stderr.write('[ERROR] {0}\n'.format(err))
+
+    def _fetch(self, connections, url):
+        """Fetches the specified URL retrying with exponential backoff.
+        """
+        u = urlparse.urlsplit(url)
+        if u.scheme not in ('http', 'https'):
+            raise Error('unsupported URL \'{0}\''.format(url))
+
+        key = (u.scheme, u.netloc)
+        for attempt in xrange(self.retries + 1):
+            if 0 != attempt:
+                time.sleep(min(2 ** attempt * 0.1, 10))
+            c = connections.get(key)
+            if c is None:
+                c = connections[key] = (httplib.HTTPSConnection
+                    if 'https' == u.scheme else httplib.HTTPConnection)(
+                        u.netloc, timeout=Defaults.CONFIRM_TIMEOUT)
+            try:
+                c.request('GET', '{0}{1}'.format(u.path or '/',
+                    '?' + u.query if u.query else ''))
+                res = c.getresponse()
+                data = res.read()
+            except (httplib.HTTPException, socket.error):
+                c.close()
+                del connections[key]
+                continue
+            if 200 == res.status:
+                return data
+            if 500 > res.status:
+                break
+        raise Error('could not confirm subscription \'{0}\''.format(url))
 
 
 class RequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
@@ -55,43 +493,80 @@ class RequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
     # header must be specified in all responses.
     protocol_version = "HTTP/1.1"
 
+    # Close idle keep-alive connections quickly, since each of them holds
+    # on to one of the worker threads while it waits for the next request.
+    timeout = Defaults.KEEPALIVE_TIMEOUT
+
+    # Buffer responses so that they go out in a single segment when the
+    # handler flushes them, instead of one small write per header line
+    # that Nagle's algorithm would hold back on keep-alive connections.
+    wbufsize = -1
+
     def do_POST(self):
+        start = time.time()
+        message_type = self.headers.getheader('x-amz-sns-message-type')
+        self.server.metrics.begin()
+        # Server-side failures are answered with 5xx, since SNS does not
+        # deliver messages again after 4xx.
         try:
-            size = int(self.headers.getheader('content-length'))
-            doc = json.loads(self.rfile.read(size))
-
-            message_type = self.headers.getheader('x-amz-sns-message-type')
-            if MessageType.CONFIRMATION == message_type:
-                _handle_confirmation(doc)
-            elif MessageType.NOTIFICATION == message_type:
-                _handle_notification(doc)
-            else:
-                raise Error('unsupported message type \'{0}\''
-                    .format(message_type))
+            self._handle_message(message_type)
+            status = 200
+        except Queue.Full:
+            status = 503
+        except (TemporaryError, sqlite3.Error), err:
+            sys.stderr.write('[ERROR] {0}\n'.format(err))
+            status = 503
         except (Error, Exception), err:
-            self.send_response(404)
+            status = 404
+        self.server.metrics.end(message_type, status, time.time() - start)
+
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        if '/metrics' != self.path:
+            self.send_response(403)
             self.send_header('Content-Length', '0')
             self.end_headers()
             return
 
+        data = self.server.metrics.render(self.server.get_queue_depths())
         self.send_response(200)
-        self.send_header('Content-Length', '0')
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
         self.end_headers()
+        self.wfile.write(data)
 
-    def do_GET(self):
-        self.send_response(403)
-        self.send_header('Content-Length', '0')
-        self.end_headers()
+    def _handle_message(self, message_type):
+        size = int(self.headers.getheader('content-length'))
+        doc = json.loads(self.rfile.read(size))
+
+        if message_type != doc.get('Type'):
+            raise Error('message type mismatch')
+        if self.server.verifier is not None:
+            self.server.verifier.verify(doc)
+
+        if MessageType.CONFIRMATION == message_type:
+            self._handle_confirmation(doc)
+        elif MessageType.NOTIFICATION == message_type:
+            if (self.server.messages is None or
+                self.server.messages.add(doc['MessageId'])):
+                try:
+                    self._handle_notification(doc)
+                except Queue.Full:
+                    if self.server.messages is not None:
+                        self.server.messages.discard(doc['MessageId'])
+                    raise
+        else:
+            raise Error('unsupported message type \'{0}\''
+                .format(message_type))
 
     def _handle_confirmation(self, data):
-        response = urllib2.urlopen(data['SubscribeURL'])
-        xml = ElementTree.XML(response.read())
-        arn = xml.find('ConfirmSubscriptionResult/SubscriptionArn')
-        print arn.text
+        self.server.confirmer.submit(data['SubscribeURL'])
 
     def _handle_notification(self, data):
-        print 'Subject: \'{0}\'\nMessage: \'{1}\'\nTime: \'{2}\'' \
-            .format(data['Subject'], data['Message'], data['Timestamp'])
+        self.server.pipeline.submit(data)
 
 
 def main():
@@ -105,15 +580,80 @@ def main():
         help='A private key file to be used when SSL is enabled.')
     parser.add_option('-c', '--cert', dest='cert',
         help='A certificate file to be used when SSL is enabled.')
+    parser.add_option('-v', '--verify', dest='verify', action='store_true',
+        help='Verify message signatures and reject the ones that are not '
+             'signed by SNS. Requires the cryptography package.')
+    parser.add_option('--dedup-size', dest='dedup_size', type='int',
+        default=Defaults.DEDUP_SIZE, help='The maximum number of recent '
+        'message IDs to remember to drop repeated deliveries. Set to 0 to '
+        'disable. This is set to 100000 by default.')
+    parser.add_option('--dedup-ttl', dest='dedup_ttl', type='int',
+        default=Defaults.DEDUP_TTL, help='The number of seconds to remember '
+        'message IDs for. This is set to 3600 seconds by default.')
+    parser.add_option('--dedup-db', dest='dedup_db', help='An sqlite '
+        'database to share seen message IDs with other processes. This '
+        'option is not required.')
+    parser.add_option('--sink', dest='sinks', action='append',
+        help='A destination to write notifications to: stdout, file:<path>, '
+             'sqlite:<path>, sqs:<queue> or exec:<command>. Can be specified '
+             'multiple times. Notifications are printed to stdout by default.')
+    parser.add_option('--sink-queue-size', dest='sink_queue_size', type='int',
+        default=Defaults.SINK_QUEUE_SIZE, help='The maximum number of '
+        'notifications waiting to be written. Notifications beyond that are '
+        'rejected with 503. This is set to 10000 by default.')
+    parser.add_option('--batch-size', dest='batch_size', type='int',
+        default=Defaults.BATCH_SIZE, help='The maximum number of '
+        'notifications to write at once. This is set to 100 by default.')
+    parser.add_option('--flush-interval', dest='flush_interval',
+        type='float', default=Defaults.FLUSH_INTERVAL, help='The maximum '
+        'number of seconds a notification can wait to be written. This is '
+        'set to 1 second by default.')
+    parser.add_option('--file-size', dest='file_size', type='int',
+        default=Defaults.FILE_SIZE, help='The size in MB after which a file '
+        'sink is rotated. This is set to 64 MB by default.')
+    parser.add_option('--dead-letter', dest='dead_letter', help='A JSONL '
+        'file to append notifications to that a sink keeps failing to '
+        'write, so that they can be replayed. They are dropped by default.')
+    parser.add_option('-t', '--threads', dest='threads', type='int',
+        default=Defaults.THREADS, help='The number of worker threads to '
+        'handle connections with. This is set to 16 by default.')
+    parser.add_option('-q', '--queue-size', dest='queue_size', type='int',
+        default=Defaults.QUEUE_SIZE, help='The maximum number of accepted '
+        'connections waiting for a worker thread. Connections beyond that '
+        'are rejected with 503. This is set to 256 by default.')
+    parser.add_option('-b', '--backlog', dest='backlog', type='int',
+        default=Defaults.BACKLOG, help='The listen backlog of the server '
+        'socket. This is set to 128 by default.')
     (opts, args) = parser.parse_args()
 
     if (0 != len(args) or
-        (opts.ssl and (opts.cert is None or opts.key is None))):
+        (opts.ssl and (opts.cert is None or opts.key is None)) or
+        1 > opts.threads or
+        # A queue size of zero would make the queues unbounded.
+        1 > opts.queue_size or
+        1 > opts.sink_queue_size):
         parser.print_help()
         return 1
 
     try:
-        server = Server(('', int(opts.port)), RequestHandler)
+        if opts.verify and x509 is None:
+            raise Error('signature verification requires cryptography')
+
+        server = Server(('', int(opts.port)), RequestHandler, opts.threads,
+            opts.queue_size, opts.backlog)
+        server.confirmer = Confirmer(Defaults.CONFIRM_THREADS,
+            Defaults.CONFIRM_QUEUE_SIZE, Defaults.CONFIRM_RETRIES)
+        server.verifier = Verifier(CertificateCache(Defaults.CERT_CACHE_SIZE,
+            Defaults.CERT_CACHE_TTL)) if opts.verify else None
+        server.messages = MessageCache(opts.dedup_size, opts.dedup_ttl,
+            MessageStore(opts.dedup_db, opts.dedup_ttl)
+                if opts.dedup_db is not None else None) \
+            if 0 < opts.dedup_size else None
+        server.pipeline = notification_sinks.Pipeline(
+            [notification_sinks.create_sink(x, opts.file_size * 1024 * 1024)
+                for x in opts.sinks or [Defaults.SINK]],
+            opts.sink_queue_size, opts.batch_size, opts.flush_interval,
+            Defaults.SINK_RETRIES, opts.dead_letter)
         if opts.ssl:
             server.socket = ssl.wrap_socket(server.socket,
                 server_side=True,
@@ -121,7 +661,7 @@ def main():
                 certfile=opts.cert,
                 keyfile=opts.key)
         server.serve_forever()
-    except Error, err:
+    except (Error, notification_sinks.Error), err:
         sys.stderr.write('[ERROR] {0}\n'.format(err))
         return 1
 
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# Copyright (c) 2014 Eugene Zhuk.
+# Use of this source code is governed by the MIT license that can be found
+# in the LICENSE file.
+
+"""Generates load on an SNS endpoint.
+
+Replays synthetic SNS subscription confirmation and notification requests
+at the specified rate against a locally running confirm_subscription.py
+and reports latency percentiles once done.
+
+Usage:
+    ./generate_load.py [options]
+"""
+
+import httplib
+import json
+import optparse
+import sys
+import threading
+import time
+import urlparse
+import uuid
+
+
+class Error(Exception):
+    pass
+
+
+class Defaults(object):
+    """Default settings.
+    """
+    URL = 'http://localhost:8080/'
+    RATE = 1000
+    DURATION = 10
+    THREADS = 16
+    CONFIRMATIONS = 0.0
+    SUBSCRIBE_URL = 'http://localhost:8081/ConfirmSubscription'
+    TOPIC_ARN = 'arn:aws:sns:us-east-1:123456789012:LoadTest'
+
+
+def _create_message(confirmation, subscribe_url):
+    message_id = str(uuid.uuid4())
+    timestamp = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+    if confirmation:
+        return 'SubscriptionConfirmation', {
+            'Type': 'SubscriptionConfirmation',
+            'MessageId': message_id,
+            'Token': message_id,
+            'TopicArn': Defaults.TOPIC_ARN,
+            'Message': 'You have chosen to subscribe to the topic.',
+            'SubscribeURL': subscribe_url,
+            'Timestamp': timestamp
+        }
+    return 'Notification', {
+        'Type': 'Notification',
+        'MessageId': message_id,
+        'TopicArn': Defaults.TOPIC_ARN,
+        'Subject': 'Load test',
+        'Message': 'Load test notification {0}'.format(message_id),
+        'Timestamp': timestamp
+    }
+
+
+class Worker(threading.Thread):
+    """Sends requests over a persistent connection at a fixed rate. The
+    schedule does not depend on response times, so that slow responses
+    show up as latency instead of a lower request rate.
+    """
+    def __init__(self, url, rate, end, opts):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.url = url
+        self.interval = 1.0 / rate
+        self.end = end
+        self.opts = opts
+        self.latencies = list()
+        self.statuses = dict()
+
+    def run(self):
+        c = None
+        n = 0
+        start = time.time()
+        while True:
+            scheduled = start + n * self.interval
+            if self.end <= scheduled:
+                break
+            delay = scheduled - time.time()
+            if 0 < delay:
+                time.sleep(delay)
+            n += 1
+
+            # Spreads confirmations evenly across requests.
+            confirmation = int(n * self.opts.confirmations) != \
+                int((n - 1) * self.opts.confirmations)
+            message_type, doc = _create_message(confirmation,
+                self.opts.subscribe_url)
+            try:
+                if c is None:
+                    c = httplib.HTTPConnection(self.url.netloc, timeout=30)
+                c.request('POST', self.url.path or '/', json.dumps(doc), {
+                    'Content-Type': 'text/plain; charset=UTF-8',
+                    'x-amz-sns-message-type': message_type,
+                    'x-amz-sns-message-id': doc['MessageId'],
+                    'x-amz-sns-topic-arn': Defaults.TOPIC_ARN
+                })
+                res = c.getresponse()
+                res.read()
+                status = res.status
+            except Exception:
+                if c is not None:
+                    c.close()
+                c = None
+                status = 'error'
+            # Latency is measured from the scheduled send time.
+            self.latencies.append(time.time() - scheduled)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+
+def _percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = optparse.OptionParser('Usage: %prog [options]')
+    parser.add_option('-u', '--url', dest='url', default=Defaults.URL,
+        help='The URL of the endpoint to send requests to. This is set to '
+             'http://localhost:8080/ by default.')
+    parser.add_option('-r', '--rate', dest='rate', type='float',
+        default=Defaults.RATE, help='The total number of requests per '
+        'second. This is set to 1000 by default.')
+    parser.add_option('-d', '--duration', dest='duration', type='float',
+        default=Defaults.DURATION, help='The number of seconds to generate '
+        'load for. This is set to 10 seconds by default.')
+    parser.add_option('-t', '--threads', dest='threads', type='int',
+        default=Defaults.THREADS, help='The number of concurrent connections. '
+        'This is set to 16 by default.')
+    parser.add_option('-c', '--confirmations', dest='confirmations',
+        type='float', default=Defaults.CONFIRMATIONS, help='The share of '
+        'subscription confirmations among requests, between 0 and 1. Only '
+        'notifications are sent by default.')
+    parser.add_option('-s', '--subscribe-url', dest='subscribe_url',
+        default=Defaults.SUBSCRIBE_URL, help='The subscribe URL to put into '
+        'confirmation requests.')
+    (opts, args) = parser.parse_args()
+
+    if (0 != len(args) or
+        0 >= opts.rate or
+        1 > opts.threads or
+        not 0 <= opts.confirmations <= 1):
+        parser.print_help()
+        return 1
+
+    try:
+        url = urlparse.urlsplit(opts.url)
+        if 'http' != url.scheme:
+            raise Error('unsupported URL \'{0}\''.format(opts.url))
+
+        start = time.time()
+        end = start + opts.duration
+        workers = [Worker(url, opts.rate / opts.threads, end, opts)
+            for _ in xrange(opts.threads)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            while w.is_alive():
+                w.join(1)
+        elapsed = time.time() - start
+
+        latencies = sorted(x for w in workers for x in w.latencies)
+        if not latencies:
+            raise Error('no requests were sent')
+        statuses = dict()
+        for w in workers:
+            for k, v in w.statuses.iteritems():
+                statuses[k] = statuses.get(k, 0) + v
+
+        print 'Requests: {0} ({1:.1f}/s)'.format(len(latencies),
+            len(latencies) / elapsed)
+        print 'Statuses: {0}'.format(', '.join('{0}: {1}'.format(k, v)
+            for k, v in sorted(statuses.items())))
+        print 'Latency: p50 {0:.2f} ms, p99 {1:.2f} ms, max {2:.2f} ms' \
+            .format(_percentile(latencies, 0.5) * 1000,
+                _percentile(latencies, 0.99) * 1000,
+                latencies[-1] * 1000)
+    except Error, err:
+        sys.stderr.write('[ERROR] {0}\n'.format(err))
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# Copyright (c) 2014 Eugene Zhuk.
+# Use of this source code is governed by the MIT license that can be found
+# in the LICENSE file.
+
+"""Notification sinks.
+
+Destinations that SNS notifications received by confirm_subscription.py
+are written to in batches. A sink is specified as <type>:<argument>, e.g.
+file:/var/log/sns/notifications.jsonl, sqlite:/var/lib/sns.db, sqs:MyQueue
+or exec:'/usr/local/bin/consumer --stdin'.
+"""
+
+import json
+import os
+import Queue
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+
+class Error(Exception):
+    pass
+
+
+def _to_json(data):
+    return json.dumps(data, separators=(',', ':'))
+
+
+class StdoutSink(object):
+    """Prints notifications to stdout.
+    """
+    def write(self, batch):
+        for data in batch:
+            print 'Subject: \'{0}\'\nMessage: \'{1}\'\nTime: \'{2}\'' \
+                .format(data.get('Subject'), data['Message'],
+                    data['Timestamp'])
+        sys.stdout.flush()
+
+
+class FileSink(object):
+    """Appends notifications to a JSONL file which is rotated once it grows
+    beyond the specified size.
+    """
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.sequence = 0
+        self.file = open(path, 'a')
+
+    def write(self, batch):
+        self.file.write(''.join(_to_json(d) + '\n' for d in batch))
+        self.file.flush()
+        if self.size <= self.file.tell():
+            self.file.close()
+            os.rename(self.path, self._rotated_path())
+            self.file = open(self.path, 'a')
+
+    def _rotated_path(self):
+        # A sequence number keeps files rotated within the same second, or
+        # by a previous process, from being overwritten.
+        stamp = time.strftime('%Y%m%d%H%M%S', time.gmtime())
+        while True:
+            self.sequence += 1
+            path = '{0}.{1}.{2}'.format(self.path, stamp, self.sequence)
+            if not os.path.exists(path):
+                return path
+
+
+class SqliteSink(object):
+    """Inserts notifications into an sqlite database.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+
+    def write(self, batch):
+        # Connect lazily since sinks are written to from another thread.
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, timeout=30)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS '
+                'notifications (message_id TEXT, topic_arn TEXT, '
+                'subject TEXT, message TEXT, timestamp TEXT, data TEXT)')
+        with self.connection as c:
+            c.executemany('INSERT INTO notifications '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [(d.get('MessageId'), d.get('TopicArn'), d.get('Subject'),
+                    d.get('Message'), d.get('Timestamp'), _to_json(d))
+                        for d in batch])
+
+
+class SqsSink(object):
+    """Sends notifications to an SQS queue. A local stand-in can be used by
+    pointing boto configuration at it.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.queue = None
+
+    def write(self, batch):
+        if self.queue is None:
+            # Imported here so that boto is only required by this sink.
+            import boto.sqs
+            self.queue = boto.connect_sqs().get_queue(self.name)
+            if self.queue is None:
+                raise Error('could not find \'{0}\''.format(self.name))
+        for i in xrange(0, len(batch), 10):
+            res = self.queue.connection.send_message_batch(self.queue,
+                [(str(j), _to_json(d), 0)
+                    for j, d in enumerate(batch[i:i + 10])])
+            if res.errors:
+                raise Error('could not send {0} message(s) to \'{1}\''
+                    .format(len(res.errors), self.name))
+
+
+class ProcessSink(object):
+    """Writes notifications as JSONL to stdin of a long running process.
+    """
+    def __init__(self, command):
+        self.command = command
+        self.proc = None
+
+    def write(self, batch):
+        if self.proc is None or self.proc.poll() is not None:
+            self.proc = subprocess.Popen(self.command, shell=True,
+                stdin=subprocess.PIPE)
+        self.proc.stdin.write(''.join(_to_json(d) + '\n' for d in batch))
+        self.proc.stdin.flush()
+
+
+def create_sink(spec, file_size):
+    """Creates a sink from its specification.
+    """
+    kind, _, arg = spec.partition(':')
+    if 'stdout' == kind:
+        return StdoutSink()
+    if not arg:
+        raise Error('invalid sink \'{0}\''.format(spec))
+    if 'file' == kind:
+        return FileSink(arg, file_size)
+    elif 'sqlite' == kind:
+        return SqliteSink(arg)
+    elif 'sqs' == kind:
+        return SqsSink(arg)
+    elif 'exec' == kind:
+        return ProcessSink(arg)
+    raise Error('unsupported sink \'{0}\''.format(spec))
+
+
+class Pipeline(object):
+    """Queues notifications and writes them to all sinks in batches from a
+    background thread. A batch is written once it reaches the specified
+    size or its oldest notification has waited for the specified number
+    of seconds. The queue is bounded to apply backpressure.
+
+    Failed writes are retried with exponential backoff. SNS has already
+    been answered by then and does not deliver the batch again, so if a
+    sink still fails, the batch is appended to the dead letter file (if
+    any) as JSONL to be replayed later, or dropped otherwise.
+    """
+    # The number of seconds to wait before the first retry.
+    RETRY_DELAY = 0.5
+
+    def __init__(self, sinks, queue_size, batch_size, interval, retries,
+            dead_letter=None):
+        self.sinks = sinks
+        self.queue = Queue.Queue(queue_size)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.retries = retries
+        self.dead_letter = dead_letter
+        t = threading.Thread(target=self._work)
+        t.daemon = True
+        t.start()
+
+    def submit(self, data):
+        """Queues a notification. Raises Queue.Full if there is no room.
+        """
+        self.queue.put_nowait(data)
+
+    def _work(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.time()
+                if 0 >= timeout:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except Queue.Empty:
+                    break
+            for sink in self.sinks:
+                self._write(sink, batch)
+
+    def _write(self, sink, batch):
+        delay = self.RETRY_DELAY
+        for i in xrange(self.retries + 1):
+            try:
+                sink.write(batch)
+                return
+            except Exception, err:
+                sys.stderr.write('[ERROR] {0}\n'.format(err))
+            if self.retries != i:
+                time.sleep(delay)
+                delay *= 2
+        if self.dead_letter is not None:
+            try:
+                with open(self.dead_letter, 'a') as f:
+                    f.write(''.join(_to_json(d) + '\n' for d in batch))
+                return
+            except IOError, err:
+                sys.stderr.write('[ERROR] could not write to \'{0}\': {1}\n'
+                    .format(self.dead_letter, err.strerror))
+        sys.stderr.write('[ERROR] dropped {0} notification(s)\n'.format(
+            len(batch)))
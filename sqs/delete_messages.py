@@ -5,25 +5,151 @@
 
 """Deletes messages from a queue.
 
-A simple script to purge all messages from the given SQS queue.
+A simple script to purge all messages from the given SQS queue. It can
+optionally drain the queue into compressed JSONL archive segments first,
+deleting each batch only once it has been safely written to disk.
 
 Usage:
     ./delete_messages.py <options>
 """
 
 import boto.sqs
+import gzip
+import json
 import optparse
+import os
 import sys
+import time
+
+from boto.sqs.message import RawMessage
 
 
 class Error(Exception):
     pass
 
 
+class Defaults(object):
+    """Default settings.
+    """
+    BATCH_SIZE = 100
+    SEGMENT_SIZE = 64
+    VISIBILITY_TIMEOUT = 300
+    WAIT_TIME = 1
+
+
+class Archive(object):
+    """Writes messages into rotating gzip compressed JSONL segments.
+    """
+    def __init__(self, path, name, size):
+        self.path = path
+        self.prefix = '{0}-{1}'.format(name,
+            time.strftime('%Y%m%d%H%M%S', time.gmtime()))
+        self.size = size
+        self.index = 0
+        self.written = 0
+        self.file = None
+        self.gzip = None
+
+    def write(self, messages):
+        """Appends messages to the current segment and makes sure they
+        reach the disk before returning.
+        """
+        if self.file is None or self.size <= self.written:
+            self._rotate()
+
+        data = ''.join(json.dumps(m, separators=(',', ':')) + '\n'
+            for m in messages)
+        self.gzip.write(data)
+        self.gzip.flush()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.written += len(data)
+
+    def close(self):
+        if self.file is not None:
+            self.gzip.close()
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+
+    def _rotate(self):
+        self.close()
+        self.index += 1
+        self.written = 0
+        self.file = open(os.path.join(self.path, '{0}-{1:05d}.jsonl.gz'
+            .format(self.prefix, self.index)), 'wb')
+        self.gzip = gzip.GzipFile(fileobj=self.file, mode='wb')
+
+
+def _to_record(m):
+    return {
+        'MessageId': m.id,
+        'Body': m.get_body(),
+        'MD5OfBody': m.md5,
+        'Attributes': m.attributes,
+        'MessageAttributes': m.message_attributes
+    }
+
+
+def _receive_batch(queue, size):
+    """Receives up to the specified number of messages from the queue.
+    """
+    batch = list()
+    while len(batch) < size:
+        messages = queue.get_messages(num_messages=min(10, size - len(batch)),
+            visibility_timeout=Defaults.VISIBILITY_TIMEOUT,
+            attributes='All',
+            message_attributes=['All'],
+            wait_time_seconds=Defaults.WAIT_TIME)
+        if not messages:
+            break
+        batch.extend(messages)
+    return batch
+
+
+def _delete_batch(queue, messages):
+    for i in xrange(0, len(messages), 10):
+        res = queue.delete_message_batch(messages[i:i + 10])
+        if res.errors:
+            raise Error('could not delete {0} message(s)'
+                .format(len(res.errors)))
+
+
+def archive_messages(queue, path, batch_size, segment_size):
+    """Drains the queue into archive segments. Every batch is deleted
+    only after it has been fsynced, so no message is ever lost.
+    """
+    queue.set_message_class(RawMessage)
+    archive = Archive(path, queue.name, segment_size * 1024 * 1024)
+    total = 0
+    try:
+        while True:
+            batch = _receive_batch(queue, batch_size)
+            if not batch:
+                break
+            archive.write([_to_record(m) for m in batch])
+            _delete_batch(queue, batch)
+            total += len(batch)
+    finally:
+        archive.close()
+    return total
+
+
 def main():
     parser = optparse.OptionParser('Usage: %prog <options>')
     parser.add_option('-q', '--queue', dest='queue', help='The SQS queue '
         'to delete messages from.')
+    parser.add_option('-a', '--archive', dest='archive', help='The directory '
+        'to archive messages to before they get deleted. This option is not '
+        'required.')
+    parser.add_option('-b', '--batch-size', dest='batch_size', type='int',
+        default=Defaults.BATCH_SIZE, help='The number of messages to write '
+        'and delete at once when archiving. This is set to 100 by default.')
+    parser.add_option('-s', '--segment-size', dest='segment_size', type='int',
+        default=Defaults.SEGMENT_SIZE, help='The uncompressed size in MB '
+        'after which a new archive segment is started. This is set to 64 MB '
+        'by default.')
     (opts, args) = parser.parse_args()
 
     if 0 != len(args) or opts.queue is None:
@@ -33,7 +159,15 @@ def main():
     try:
         c = boto.connect_sqs()
         queue = c.get_queue(opts.queue)
-        queue.clear()
+        if queue is None:
+            raise Error('could not find \'{0}\''.format(opts.queue))
+
+        if opts.archive is not None:
+            total = archive_messages(queue, opts.archive, opts.batch_size,
+                opts.segment_size)
+            print '{0}: {1} archived'.format(opts.queue, total)
+        else:
+            queue.clear()
     except Error, err:
         sys.stderr.write('[ERROR] {0}\n'.format(err))
         return 1
@@ -43,4 +177,3 @@ def main():
 
 if __name__ == '__main__':
     sys.exit(main())
-
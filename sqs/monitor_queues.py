@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# Copyright (c) 2014 Eugene Zhuk.
+# Use of this source code is governed by the MIT license that can be found
+# in the LICENSE file.
+
+"""Monitors a fleet of queues.
+
+Selects SQS queues by name prefix and/or regular expression across one or
+more regions, samples their depth concurrently and keeps a short history
+of samples for every queue to show trends. The same selection can also be
+purged or redriven to the queues they are dead letter queues for.
+
+Usage:
+    ./monitor_queues.py [options]
+"""
+
+import collections
+import optparse
+import re
+import sys
+import time
+
+from multiprocessing.pool import ThreadPool
+
+import move_messages
+
+
+class Error(Exception):
+    pass
+
+
+class Defaults(object):
+    """Default settings.
+    """
+    COUNT = 1
+    INTERVAL = 60
+    HISTORY = 60
+    THREADS = 32
+    WORKERS = 4
+    RATE = 0
+
+
+Sample = collections.namedtuple('Sample',
+    ['time', 'visible', 'in_flight', 'delayed'])
+
+
+class Series(object):
+    """Keeps a bounded history of samples of a single queue.
+    """
+    def __init__(self, size):
+        self.samples = collections.deque(maxlen=size)
+
+    def add(self, sample):
+        self.samples.append(sample)
+
+    def last(self):
+        return self.samples[-1]
+
+    def rate(self):
+        """Returns the change in the number of visible messages per second
+        over the whole history.
+        """
+        if 2 > len(self.samples):
+            return 0.0
+        first, last = self.samples[0], self.samples[-1]
+        return (last.visible - first.visible) / (last.time - first.time)
+
+    def age(self):
+        """Returns the number of seconds the queue has been non-empty, as
+        far as the history goes.
+        """
+        last = self.samples[-1]
+        since = last.time
+        for s in reversed(self.samples):
+            if 0 == s.visible + s.in_flight:
+                break
+            since = s.time
+        return last.time - since
+
+
+def select_queues(pool, regions, prefix, regex):
+    """Returns (region, queue) tuples of all queues that match the specified
+    prefix and regular expression. The prefix is applied server-side.
+    """
+    def _list(region):
+        c = move_messages.connect(region)
+        return [(region, q) for q in c.get_all_queues(prefix)
+            if regex is None or regex.search(q.name)]
+    return sorted((x for xs in pool.map(_list, regions) for x in xs),
+        key=lambda x: (x[0], x[1].name))
+
+
+def sample_queues(pool, queues):
+    """Fetches attributes of all queues concurrently and returns a list of
+    samples in the same order.
+    """
+    def _sample(x):
+        region, queue = x
+        a = move_messages.connect(region).get_queue_attributes(queue, 'All')
+        return Sample(time.time(),
+            int(a['ApproximateNumberOfMessages']),
+            int(a['ApproximateNumberOfMessagesNotVisible']),
+            int(a['ApproximateNumberOfMessagesDelayed']))
+    return pool.map(_sample, queues)
+
+
+def print_series(queues, series):
+    print '{0:<16} {1:<40} {2:>10} {3:>10} {4:>10} {5:>10} {6:>8}'.format(
+        'REGION', 'QUEUE', 'VISIBLE', 'IN-FLIGHT', 'DELAYED', 'RATE/S', 'AGE')
+    for region, queue in queues:
+        s = series[(region, queue.name)]
+        last = s.last()
+        print ('{0:<16} {1:<40} {2:>10} {3:>10} {4:>10} {5:>+10.2f} '
+            '{6:>8.0f}').format(region, queue.name, last.visible,
+                last.in_flight, last.delayed, s.rate(), s.age())
+    sys.stdout.flush()
+
+
+def monitor_queues(pool, queues, count, interval, history):
+    series = dict(((region, q.name), Series(history)) for region, q in queues)
+    for i in xrange(count):
+        if 0 != i:
+            time.sleep(interval)
+        for (region, queue), sample in zip(queues,
+                sample_queues(pool, queues)):
+            series[(region, queue.name)].add(sample)
+        print_series(queues, series)
+
+
+def purge_queues(pool, queues):
+    def _purge(x):
+        region, queue = x
+        move_messages.connect(region).get_queue(queue.name).clear()
+        print '{0}/{1}: purged'.format(region, queue.name)
+    pool.map(_purge, queues)
+
+
+def redrive_queues(pool, queues, suffix, workers, rate):
+    """Moves messages from every selected queue to the queue with the same
+    name without the specified suffix, sharing a single rate limit.
+    """
+    limiter = move_messages.RateLimiter(rate)
+    def _redrive(x):
+        region, queue = x
+        if not queue.name.endswith(suffix):
+            raise Error('\'{0}\' does not end with \'{1}\''
+                .format(queue.name, suffix))
+        target = queue.name[:-len(suffix)]
+        total = move_messages.move_messages((queue.name, region),
+            (target, region), workers, limiter)
+        print '{0}/{1} -> {2}: {3} moved'.format(region, queue.name, target,
+            total)
+    pool.map(_redrive, queues)
+
+
+def main():
+    parser = optparse.OptionParser('Usage: %prog [options]')
+    parser.add_option('-p', '--prefix', dest='prefix', default='',
+        help='Select queues whose names start with this prefix.')
+    parser.add_option('-e', '--regex', dest='regex',
+        help='Select queues whose names match this regular expression.')
+    parser.add_option('-r', '--region', dest='regions', action='append',
+        help='The name of the region to select queues in. All regions are '
+             'used by default.')
+    parser.add_option('-c', '--count', dest='count', type='int',
+        default=Defaults.COUNT, help='The number of times to sample queue '
+        'depth. This is set to 1 by default.')
+    parser.add_option('-i', '--interval', dest='interval', type='float',
+        default=Defaults.INTERVAL, help='The number of seconds between '
+        'samples. This is set to 60 seconds by default.')
+    parser.add_option('--history', dest='history', type='int',
+        default=Defaults.HISTORY, help='The number of samples to keep per '
+        'queue. This is set to 60 by default.')
+    parser.add_option('-t', '--threads', dest='threads', type='int',
+        default=Defaults.THREADS, help='The number of concurrent requests. '
+        'This is set to 32 by default.')
+    parser.add_option('--purge', dest='purge', action='store_true',
+        help='Purge all messages from the selected queues.')
+    parser.add_option('--redrive', dest='redrive', metavar='SUFFIX',
+        help='Move messages from the selected queues to the queues with the '
+             'same name without this suffix (e.g., -DLQ).')
+    parser.add_option('-w', '--workers', dest='workers', type='int',
+        default=Defaults.WORKERS, help='The number of workers per queue to '
+        'redrive messages with. This is set to 4 by default.')
+    parser.add_option('--rate', dest='rate', type='int',
+        default=Defaults.RATE, help='The maximum total number of messages '
+        'to redrive per second. Not limited by default.')
+    (opts, args) = parser.parse_args()
+
+    if (0 != len(args) or
+        (opts.purge and opts.redrive is not None) or
+        1 > opts.count or
+        1 > opts.threads):
+        parser.print_help()
+        return 1
+
+    try:
+        regex = re.compile(opts.regex) if opts.regex is not None else None
+        pool = ThreadPool(opts.threads)
+
+        regions = move_messages.get_regions(opts.regions)
+        queues = select_queues(pool, regions, opts.prefix, regex)
+        if not queues:
+            raise Error('could not find any matching queues')
+
+        if opts.purge:
+            purge_queues(pool, queues)
+        elif opts.redrive is not None:
+            redrive_queues(pool, queues, opts.redrive, opts.workers,
+                opts.rate)
+        else:
+            monitor_queues(pool, queues, opts.count, opts.interval,
+                opts.history)
+    except (Error, move_messages.Error, re.error), err:
+        sys.stderr.write('[ERROR] {0}\n'.format(err))
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
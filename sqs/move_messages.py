@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# Copyright (c) 2014 Eugene Zhuk.
+# Use of this source code is governed by the MIT license that can be found
+# in the LICENSE file.
+
+"""Moves messages between queues.
+
+Moves all messages from one SQS queue to another (e.g., to redrive a dead
+letter queue back to its source queue), optionally across regions. Every
+batch is deleted from the source queue only after it has been accepted by
+the target queue.
+
+Usage:
+    ./move_messages.py <options>
+"""
+
+import boto.sqs
+import optparse
+import sys
+import threading
+import time
+
+from boto.sqs.message import RawMessage
+
+
+class Error(Exception):
+    pass
+
+
+class Defaults(object):
+    """Default settings.
+    """
+    WORKERS = 4
+    RATE = 0
+    VISIBILITY_TIMEOUT = 300
+    WAIT_TIME = 1
+
+
+class RateLimiter(object):
+    """A thread-safe token bucket that caps the number of messages per
+    second shared by all workers. A rate of zero disables the limit.
+    """
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self, n=1):
+        if 0 >= self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.rate,
+                    self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if n <= self.tokens or self.rate < n:
+                    self.tokens -= n
+                    return
+                delay = (n - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+_local = threading.local()
+
+
+def connect(region):
+    """Returns a connection to SQS in the specified region (or the default
+    one, if none) that belongs to the calling thread, since connections can
+    not be shared between threads.
+    """
+    if not hasattr(_local, 'connections'):
+        _local.connections = dict()
+    if region not in _local.connections:
+        _local.connections[region] = boto.connect_sqs() if region is None \
+            else boto.sqs.connect_to_region(region)
+    return _local.connections[region]
+
+
+def get_regions(regions):
+    if regions is not None:
+        return [r.name for r in boto.sqs.regions() if r.name in regions]
+    else:
+        return [r.name for r in boto.sqs.regions()
+            if not r.name.startswith(('us-gov-', 'cn-'))]
+
+
+def get_queue(c, name):
+    queue = c.get_queue(name)
+    if queue is None:
+        raise Error('could not find \'{0}\''.format(name))
+    queue.set_message_class(RawMessage)
+    return queue
+
+
+def move_batch(source, target, messages):
+    """Sends a batch of messages to the target queue and deletes the ones
+    that were accepted from the source queue.
+    """
+    res = target.connection.send_message_batch(target,
+        [(str(i), m.get_body(), 0, m.message_attributes)
+            for i, m in enumerate(messages)])
+    sent = [messages[int(r['id'])] for r in res.results]
+    if sent and source.delete_message_batch(sent).errors:
+        raise Error('could not delete sent message(s) from \'{0}\''
+            .format(source.name))
+    if res.errors:
+        raise Error('could not send {0} message(s) to \'{1}\''
+            .format(len(res.errors), target.name))
+    return len(sent)
+
+
+class Counter(object):
+    """A thread-safe counter.
+    """
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def add(self, n):
+        with self.lock:
+            self.value += n
+
+
+class Worker(threading.Thread):
+    """Moves messages until the source queue appears to be empty.
+    """
+    def __init__(self, source, target, limiter, counter):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.source = source
+        self.target = target
+        self.limiter = limiter
+        self.counter = counter
+        self.error = None
+
+    def run(self):
+        try:
+            # Connections are not thread-safe, so each worker gets its own.
+            source = get_queue(connect(self.source[1]), self.source[0])
+            target = get_queue(connect(self.target[1]), self.target[0])
+            while True:
+                messages = source.get_messages(num_messages=10,
+                    visibility_timeout=Defaults.VISIBILITY_TIMEOUT,
+                    message_attributes=['All'],
+                    wait_time_seconds=Defaults.WAIT_TIME)
+                if not messages:
+                    break
+                self.limiter.acquire(len(messages))
+                self.counter.add(move_batch(source, target, messages))
+        except Exception, err:
+            self.error = err
+
+
+def move_messages(source, target, workers, limiter):
+    """Moves messages using the specified number of parallel workers and
+    returns the total number of messages moved. Both the source and the
+    target are (name, region) tuples.
+    """
+    counter = Counter()
+    workers = [Worker(source, target, limiter, counter)
+        for _ in xrange(workers)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        while w.is_alive():
+            w.join(1)
+
+    errors = [w.error for w in workers if w.error is not None]
+    if errors:
+        raise Error('{0} (moved {1})'.format(errors[0], counter.value))
+    return counter.value
+
+
+def main():
+    parser = optparse.OptionParser('Usage: %prog <options>')
+    parser.add_option('-s', '--source', dest='source', help='The SQS queue '
+        'to move messages from.')
+    parser.add_option('-t', '--target', dest='target', help='The SQS queue '
+        'to move messages to.')
+    parser.add_option('--source-region', dest='source_region',
+        help='The region of the source queue. This option is not required.')
+    parser.add_option('--target-region', dest='target_region',
+        help='The region of the target queue. This option is not required.')
+    parser.add_option('-w', '--workers', dest='workers', type='int',
+        default=Defaults.WORKERS, help='The number of parallel workers. This '
+        'is set to 4 by default.')
+    parser.add_option('-r', '--rate', dest='rate', type='int',
+        default=Defaults.RATE, help='The maximum number of messages to move '
+        'per second. Not limited by default.')
+    (opts, args) = parser.parse_args()
+
+    if (0 != len(args) or
+        opts.source is None or
+        opts.target is None or
+        1 > opts.workers):
+        parser.print_help()
+        return 1
+
+    try:
+        total = move_messages((opts.source, opts.source_region),
+            (opts.target, opts.target_region),
+            opts.workers,
+            RateLimiter(opts.rate))
+        print '{0} -> {1}: {2} moved'.format(opts.source, opts.target, total)
+    except Error, err:
+        sys.stderr.write('[ERROR] {0}\n'.format(err))
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())